@@ -1,4 +1,8 @@
 #!/usr/bin/env python3
+import atexit
+import collections
+import functools
+import itertools
 import json
 import logging
 import os
@@ -9,10 +13,9 @@ import click
 import requests
 from loguru import logger
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from tabulate import tabulate
 
 import plex
-from utils import misc, themoviedb, sheets
+from utils import misc, dispatch, metrics, sql, scheduler, output
 
 ############################################################
 # INIT
@@ -21,6 +24,8 @@ from utils import misc, themoviedb, sheets
 
 # Globals
 cfg = None
+config_dir = None
+database_path = None
 manager = None
 
 # Logging
@@ -54,8 +59,21 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
     show_default=True,
     default=os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "activity.log")
 )
-def app(verbose, config_path, log_path):
-    global cfg
+@click.option(
+    '--snapshot',
+    is_flag=True,
+    default=False,
+    help='Run scans against a local indexed snapshot of the Plex database'
+)
+@click.option(
+    '--metrics-path',
+    envvar='METRICS_PATH',
+    type=click.Path(file_okay=True, dir_okay=False),
+    help='Dump query and request metrics on exit, as json or in the prometheus text format for a .prom path'
+)
+@click.pass_context
+def app(ctx, verbose, config_path, log_path, snapshot, metrics_path):
+    global cfg, config_dir, database_path
 
     # Ensure paths are full paths
     if not config_path.startswith(os.path.sep):
@@ -66,6 +84,7 @@ def app(verbose, config_path, log_path):
     # Load config
     from utils.config import Config
     cfg = Config(config_path=config_path).cfg
+    config_dir = os.path.dirname(config_path)
 
     # Load logger
     log_levels = {0: 'INFO', 1: 'DEBUG', 2: 'TRACE'}
@@ -87,9 +106,303 @@ def app(verbose, config_path, log_path):
     logger.info("%s = %r" % ("CONFIG_PATH".ljust(12), config_path))
     logger.info("%s = %r" % ("LOG_PATH".ljust(12), log_path))
     logger.info("%s = %r" % ("LOG_LEVEL".ljust(12), log_level))
+
+    # Dump metrics on exit
+    if metrics_path:
+        if not metrics_path.startswith(os.path.sep):
+            metrics_path = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), metrics_path)
+        atexit.register(metrics.dump, metrics_path, ctx.invoked_subcommand)
+        logger.info("%s = %r" % ("METRICS_PATH".ljust(12), metrics_path))
+
+    # Use snapshot of database for scans
+    database_path = cfg.plex.database_path
+    if snapshot:
+        from utils import snapshot as db_snapshot
+        snapshot_path = cfg.snapshot.path or os.path.join(config_dir, 'plex_snapshot.db')
+        database_path = db_snapshot.get_snapshot(cfg.plex.database_path, snapshot_path, cfg.snapshot.max_age)
+        if database_path is None:
+            logger.error(f"Failed creating snapshot of the Plex database at: {snapshot_path!r}")
+            sys.exit(1)
+        logger.info("%s = %r" % ("SNAPSHOT".ljust(12), database_path))
     return
 
 
+def resolve_libraries(library_names, all_libraries):
+    """Return the libraries to scan, every movie and show library with all_libraries, exits when one is missing"""
+    if not library_names and not all_libraries:
+        logger.error("You must specify either a library or --all-libraries!")
+        sys.exit(1)
+
+    # resolve all sections at once
+    libraries = plex.library.find_libraries(database_path, None if all_libraries else library_names)
+    if libraries is None:
+        logger.error("Failed to lookup the libraries to scan")
+        sys.exit(1)
+
+    if all_libraries:
+        return [section for section in libraries if section['section_type'] in (1, 2)]
+
+    found_names = {section['name'] for section in libraries}
+    for library_name in library_names:
+        if library_name not in found_names:
+            logger.error(f"Failed to find library: {library_name!r}")
+            sys.exit(1)
+    return libraries
+
+
+def describe_libraries(library_names):
+    if len(library_names) == 1:
+        return f"library: {library_names[0]!r}"
+    return f"libraries: {', '.join(map(repr, library_names))}"
+
+
+def parse_duration_option(ctx, param, value):
+    try:
+        return scheduler.parse_duration(value) if value else None
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
+def parse_allowed_hours_option(ctx, param, value):
+    try:
+        return scheduler.parse_allowed_hours(value) if value else None
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
+def get_scheduler(concurrency, adaptive=False, max_duration=None, allowed_hours=None):
+    """Build the scheduler pacing the actions of a command, the server load is only checked when limits are set"""
+    load_limits = {key: cfg.scheduler[f"max_{key}"] for key in ('sessions', 'transcodes', 'activities')
+                   if cfg.scheduler[f"max_{key}"] is not None}
+
+    def load_check():
+        load = plex.actions.get_server_load(cfg)
+        if load is None:
+            # an unknown load never holds back actions
+            return None
+        for key, limit in load_limits.items():
+            if load[key] > limit:
+                return f"the server has {load[key]} {key}, more than {limit}"
+        return None
+
+    return scheduler.AdaptiveScheduler(concurrency, adaptive=adaptive, target_latency=cfg.scheduler.target_latency,
+                                       max_error_rate=cfg.scheduler.max_error_rate, window=cfg.scheduler.window,
+                                       max_duration=max_duration, allowed_hours=allowed_hours,
+                                       load_check=load_check if load_limits else None,
+                                       check_interval=cfg.scheduler.check_interval)
+
+
+def plan_section_refreshes(libraries):
+    """
+    Return the libraries whose items with a missing poster are better refreshed with a single section refresh, those
+    with at least section_refresh.min_items of them, making up at least section_refresh.min_ratio of the library.
+
+    A section refresh is forced for every item of the library, so below half of the library it costs the server more
+    than refreshing the items one by one. Items are counted in the live database, not a snapshot, as the refreshes are
+    verified against it.
+    """
+    missing_counts = plex.metadata.count_libraries_items_missing_posters(cfg.plex.database_path, libraries)
+    library_counts = plex.metadata.count_libraries_items(cfg.plex.database_path, libraries)
+    if missing_counts is None or library_counts is None:
+        logger.warning("Failed to count the items with missing posters, every item is refreshed one by one")
+        return {}
+
+    planned = {}
+    for section in libraries:
+        missing, total = missing_counts.get(section['name'], 0), library_counts.get(section['name'], 0)
+        if total and missing >= cfg.section_refresh.min_items and missing / total >= cfg.section_refresh.min_ratio:
+            logger.info(f"Refreshing library {section['name']!r} with a section refresh, {missing} of its {total} "
+                        f"items have a missing poster")
+            planned[section['name']] = missing
+    return planned
+
+
+def wait_for_section_refresh(section, missing):
+    """
+    Wait until the number of items of section with a missing poster, missing before the refresh, settled, returns
+    that number.
+
+    The settle time only starts once the number first drops, a refresh queued behind other activity of the server
+    is waited for until section_refresh.verify_timeout instead of being taken as done.
+    """
+    progress = {'remaining': missing, 'changed_at': None}
+
+    def settled():
+        counts = plex.metadata.count_libraries_items_missing_posters(cfg.plex.database_path, [section])
+        if counts is None:
+            return False
+
+        remaining = counts.get(section['name'], 0)
+        if remaining < missing and remaining != progress['remaining']:
+            progress['remaining'], progress['changed_at'] = remaining, time.monotonic()
+        if remaining == 0:
+            return True
+        return progress['changed_at'] is not None and \
+            time.monotonic() - progress['changed_at'] >= cfg.section_refresh.settle_time
+
+    if not misc.wait_for(settled, timeout=cfg.section_refresh.verify_timeout):
+        logger.warning(f"Timed out waiting for the section refresh of library {section['name']!r} to settle")
+    return progress['remaining']
+
+
+def open_output(output_format, output_path, scan, fields, types):
+    """Open the writer streaming rows to output_path, by default <scan>.<format> in the current directory"""
+    output_path = os.path.abspath(output_path or f"{scan}.{output_format}")
+    writer = output.open_writer(output_format, output_path, fields, types)
+    if writer is None:
+        logger.error(f"Failed opening the {output_format} output: {output_path!r}")
+        sys.exit(1)
+
+    logger.info(f"Writing {output_format} output to: {output_path!r}")
+    return writer
+
+
+def get_state_store():
+    from utils.state import StateStore
+    state_path = cfg.state.path or os.path.join(config_dir, 'state.db')
+    retry_delay = cfg.state.retry_delay if cfg.state.retry_delay is not None else 3600
+    return StateStore(state_path, retry_delay=retry_delay)
+
+
+def find_incremental_items(store, scan, library, find_items, item_mark, item_id):
+    """
+    Stream the failed items of the last scans of library that are due for a retry, followed by the items after the
+    high-water mark of the last scan, find_items is called with the after and item_ids filters.
+
+    Returns the results and a dict holding the high-water mark of the streamed items and the ids of the retried
+    items that no longer needed action, or None when the items could not be found.
+    """
+    mark = store.get_mark(scan, library)
+    retry_item_ids = store.get_retry_item_ids(scan, library)
+    if mark is not None:
+        logger.debug(f"Scanning items of library {library!r} after: {mark!r}")
+    if retry_item_ids:
+        logger.info(f"Retrying {len(retry_item_ids)} previously failed items of library: {library!r}")
+
+    retry_results = find_items(item_ids=retry_item_ids) if retry_item_ids else ()
+    new_results = find_items(after=mark)
+    if retry_results is None or new_results is None:
+        return None, None
+
+    retry_ids = set(retry_item_ids)
+    progress = {'mark': mark, 'resolved': set(retry_ids)}
+
+    def iter_items():
+        for item in retry_results:
+            progress['resolved'].discard(item_id(item))
+            yield item
+        for item in new_results:
+            # results are ordered by their mark
+            progress['mark'] = item_mark(item)
+            if item_id(item) not in retry_ids:
+                yield item
+
+    return iter_items(), progress
+
+
+def check_scan_options(auto_mode, incremental, resume):
+    if resume and auto_mode == '0':
+        logger.error("You must specify an --auto-mode to resume runs!")
+        sys.exit(1)
+    if resume and incremental:
+        logger.error("You can not combine --resume with --incremental!")
+        sys.exit(1)
+
+
+def find_queued_items(store, scan, library_names, find_items, record, item_id):
+    """
+    Stream the items of the libraries pending in the queue of scan, when none are left the items found by
+    find_items are queued first, so an interrupted run resumes where it stopped.
+
+    Returns None when the items could not be found.
+    """
+    queued = store.count_queued(scan, library_names)
+    if queued:
+        logger.info(f"Resuming {queued} queued items of {describe_libraries(library_names)}")
+    else:
+        results = find_items()
+        if results is None:
+            return None
+        queued = store.enqueue(scan, ((item.library_name, item_id(item), item._asdict()) for item in results))
+        logger.info(f"Queued {queued} items of {describe_libraries(library_names)}")
+
+    return (record(**item) for item in store.iter_queued(scan, library_names))
+
+
+def find_incremental_libraries_items(store, scan, library_names, find_items, item_mark, item_id):
+    """
+    Chain the incremental scans of every library, find_items is called with the library name and the filters.
+
+    Returns the results and a dict of library name to the progress of its scan, or None when the items of a library
+    could not be found.
+    """
+    library_results, progresses = [], {}
+    for library_name in library_names:
+        results, progresses[library_name] = find_incremental_items(
+            store, scan, library_name, functools.partial(find_items, library_name), item_mark, item_id)
+        if results is None:
+            return None, None
+        library_results.append(results)
+
+    return itertools.chain.from_iterable(library_results), progresses
+
+
+def finish_incremental_scans(store, scan, progresses, outcomes, advance_marks=True):
+    """
+    Record the outcomes of the scans of every library, a dict of status to (library name, item id) pairs, and store
+    their marks
+    """
+    for library_name, progress in progresses.items():
+        finish_incremental_scan(store, scan, library_name, progress, {
+            status: [item_id for item_library, item_id in item_ids if item_library == library_name]
+            for status, item_ids in outcomes.items()
+        }, advance_mark=advance_marks)
+
+
+def finish_incremental_scan(store, scan, library, progress, outcomes, advance_mark=True):
+    """
+    Record the outcomes of a scan, a dict of status to item ids, and store its new high-water mark.
+
+    The mark is kept when not advance_mark, for scans stopped before every item they read was acted on.
+    """
+    for status, item_ids in outcomes.items():
+        store.record_outcomes(scan, library, item_ids, status)
+    store.record_outcomes(scan, library, progress['resolved'], 'resolved')
+    if advance_mark and progress['mark'] is not None:
+        store.set_mark(scan, library, progress['mark'])
+
+
+def run_watch_scan(store, scan, library, find_items, item_mark, item_id, action, describe, concurrency,
+                   scan_scheduler):
+    """Act on the items of an incremental scan, returns False when the items could not be found"""
+    results, progress = find_incremental_items(store, scan, library, find_items, item_mark, item_id)
+    if results is None:
+        logger.error(f"Failed to find items of {scan} for library: {library!r}")
+        return False
+
+    try:
+        # only dispatch when there is something to act on
+        first_item = next(results, None)
+        if first_item is None:
+            finish_incremental_scan(store, scan, library, progress, {})
+            return True
+
+        dispatch_results = dispatch.dispatch(itertools.chain([first_item], results), action,
+                                             concurrency=concurrency, describe=describe, scheduler=scan_scheduler,
+                                             keep_succeeded=True)
+    except sql.QueryError:
+        # the mark is kept, so the items are read again on the next change
+        logger.error(f"Failed reading the items of {scan} for library: {library!r}")
+        return False
+    finish_incremental_scan(store, scan, library, progress, {
+        'succeeded': [item_id(item) for item in dispatch_results['succeeded_items']],
+        'failed': [item_id(item) for item in dispatch_results['failed']],
+    })
+    logger.info(f"Finished {scan} of library {library!r}: {dispatch_results['succeeded']} succeeded, "
+                f"{len(dispatch_results['failed'])} failed")
+    return True
+
+
 ############################################################
 # COMMANDS
 ############################################################
@@ -97,50 +410,203 @@ def app(verbose, config_path, log_path):
 @app.command(help='Find unalayzed media items')
 @click.option(
     '-l', '--library',
-    help='Library to search for unanalyzed items', required=True
+    multiple=True,
+    help='Library to search for unanalyzed items, can be given multiple times'
 )
+@click.option('--all-libraries', is_flag=True, default=False, help='Search every movie and show library')
 @click.option('--auto-mode', '-a', required=False, default='0', help='Automatically perform specific action')
-def unanalyzed_media(library, auto_mode):
-    global cfg
+@click.option(
+    '-c', '--concurrency',
+    type=click.IntRange(min=1), default=1, show_default=True,
+    help='Number of analyze requests to run concurrently'
+)
+@click.option('--incremental', is_flag=True, default=False,
+              help='Only scan items added since the last incremental scan, and retry previously failed items')
+@click.option('--resume', is_flag=True, default=False,
+              help='Queue the items in the state database, resuming the queue of an interrupted run')
+@click.option('--adaptive', is_flag=True, default=False,
+              help='Adapt the concurrency, up to --concurrency, to the latency and error rate of the server')
+@click.option('--max-duration', callback=parse_duration_option,
+              help='Stop sending analyze requests after this long, e.g. 90m or 2h')
+@click.option('--allowed-hours', callback=parse_allowed_hours_option,
+              help='Only send analyze requests during these local hours, e.g. 1-6 or 22-6,12-14')
+@click.option('--preflight', is_flag=True, default=False,
+              help='Only analyze items whose file exists locally with the expected size, see preflight.path_mappings')
+@click.option('--output', 'output_format', type=click.Choice(output.FORMATS),
+              help='Write the found items to a file instead of showing them, items are not prompted for')
+@click.option('--output-path', help='File the found items are written to, defaults to <command>.<format>')
+def unanalyzed_media(library, all_libraries, auto_mode, concurrency, incremental, resume, adaptive, max_duration,
+                     allowed_hours, preflight, output_format, output_path):
+    check_scan_options(auto_mode, incremental, resume)
+    libraries = resolve_libraries(library, all_libraries)
+    library_names = [section['name'] for section in libraries]
 
     # retrieve items with unanalyzed media
-    results = plex.metadata.find_items_unanalyzed(cfg.plex.database_path, library)
+    store = progresses = run_id = None
+    if incremental:
+        store = get_state_store()
+        results, progresses = find_incremental_libraries_items(
+            store, 'unanalyzed_media', library_names,
+            functools.partial(plex.metadata.find_items_unanalyzed, database_path),
+            item_mark=plex.metadata.unanalyzed_mark, item_id=lambda item: item.media_item_id)
+    elif resume:
+        store = get_state_store()
+        run_id = store.start_run('unanalyzed_media')
+        results = find_queued_items(
+            store, 'unanalyzed_media', library_names,
+            lambda: plex.metadata.find_libraries_items_unanalyzed(database_path, libraries),
+            plex.metadata.UnanalyzedItem, item_id=lambda item: item.media_item_id)
+    else:
+        results = plex.metadata.find_libraries_items_unanalyzed(database_path, libraries)
     if results is None:
-        logger.error(f"Failed to find unanalyzed media items for library: {library!r}")
+        logger.error(f"Failed to find unanalyzed media items for {describe_libraries(library_names)}")
         sys.exit(1)
 
-    if not results:
-        logger.info(f"There were no media items without analysis in library: {library!r}")
-        sys.exit(0)
-
-    logger.info(f"Found {len(results)} media items without analysis in library: {library!r}")
+    writer = None
+    if output_format:
+        writer = open_output(output_format, output_path, 'unanalyzed_media', plex.metadata.UnanalyzedItem._fields,
+                             plex.metadata.UNANALYZED_ITEM_TYPES)
 
-    # process found items
-    for item in results:
-        if 'file' not in item or 'metadata_item_id' not in item:
-            logger.debug(f"Skipping item as there was no title or metadata_item_id found: {item}")
-            continue
+    found_items = collections.Counter()
 
-        logger.info(f"Media analysis was required for: {item['file']}")
+    # stat the files of the items before anything is sent to plex
+    preflight_counts = collections.Counter()
+    rejected_ids = []
 
-        if auto_mode == '0':
-            # ask user what to-do
-            logger.info("What would you like to-do with this item? (0 = skip, 1 = analyze)")
-            user_input = input()
-            if user_input is None or user_input == '0':
+    def analyzable_items(items):
+        from utils import preflight as file_preflight
+        for item, status, local_path, size in file_preflight.iter_checked(
+                items, lambda item: item.file, lambda item: item.size, path_mappings=cfg.preflight.path_mappings,
+                workers=cfg.preflight.workers):
+            preflight_counts[status] += 1
+            if status == file_preflight.ANALYZABLE:
+                yield item
                 continue
-        else:
-            # user the determined auto mode
-            user_input = auto_mode
 
-        # act on user input
-        if user_input == '1':
-            # do analyze
-            logger.debug("Analyzing metadata...")
-            if plex.actions.analyze_metadata_item(cfg, item['metadata_item_id']):
-                logger.info("Media analysis successful!")
+            if status == file_preflight.MISSING:
+                logger.warning(f"Skipping media item with a missing file: {local_path}")
             else:
+                logger.warning(f"Skipping media item with a file of {size} bytes instead of {item.size}: {local_path}")
+            found_items[item.library_name] += 1
+            if progresses is not None:
+                rejected_ids.append((item.library_name, item.media_item_id))
+
+            # checkpoint the queued item, it is retried once the file is back
+            if run_id is not None:
+                store.complete_queued('unanalyzed_media', item.library_name, item.media_item_id, run_id, 'failed')
+
+    if preflight:
+        results = analyzable_items(results)
+
+    # determine which items to analyze, results are streamed so work starts on the first row
+    skipped_ids = []
+
+    def skip_item(item):
+        # only the ids of skipped items are kept, and only when the scan records them
+        if progresses is not None:
+            skipped_ids.append((item.library_name, item.media_item_id))
+        if run_id is not None:
+            store.complete_queued('unanalyzed_media', item.library_name, item.media_item_id, run_id, 'skipped')
+
+    def items_to_analyze():
+        for item in results:
+            found_items[item.library_name] += 1
+            if writer is not None:
+                writer.write(item)
+            else:
+                logger.info(f"Media analysis was required for: {item.file}")
+
+            if auto_mode == '0' and writer is not None:
+                # only report the item
+                skip_item(item)
                 continue
+            elif auto_mode == '0':
+                # ask user what to-do
+                logger.info("What would you like to-do with this item? (0 = skip, 1 = analyze)")
+                user_input = input()
+                if user_input is None or user_input == '0':
+                    skip_item(item)
+                    continue
+            else:
+                # user the determined auto mode
+                user_input = auto_mode
+
+            # act on user input
+            if user_input == '1':
+                yield item
+            else:
+                skip_item(item)
+
+    def analyze_item(item):
+        logger.debug(f"Analyzing metadata for: {item.file}")
+        analyzed = plex.actions.analyze_metadata_item(cfg, item.metadata_item_id)
+        if analyzed:
+            logger.info(f"Media analysis successful for: {item.file}")
+
+        # checkpoint the queued item
+        if run_id is not None:
+            store.complete_queued('unanalyzed_media', item.library_name, item.media_item_id, run_id,
+                                  'done' if analyzed else 'failed')
+        return analyzed
+
+    # collect all decisions before dispatching when interactive
+    if auto_mode == '0' and writer is None:
+        items = list(items_to_analyze())
+        total = len(items)
+    else:
+        items = items_to_analyze()
+        # count the items up front so the progress has an eta
+        total = None
+        if run_id is not None:
+            total = store.count_queued('unanalyzed_media', library_names)
+        elif progresses is None:
+            total = plex.metadata.count_libraries_items_unanalyzed(database_path, libraries)
+
+    # dispatch analyze requests of all libraries, only paced when something may be analyzed
+    scan_scheduler = None
+    if auto_mode == '1' or (auto_mode == '0' and writer is None):
+        scan_scheduler = get_scheduler(concurrency, adaptive=adaptive, max_duration=max_duration,
+                                       allowed_hours=allowed_hours)
+    dispatch_results = dispatch.dispatch(items, analyze_item, concurrency=concurrency, total=total,
+                                         describe=lambda item: item.file, scheduler=scan_scheduler,
+                                         keep_succeeded=progresses is not None)
+
+    if writer is not None:
+        writer.close()
+    if progresses is not None:
+        # files checked ahead of a stopped dispatch were read but never analyzed, so keep the marks
+        finish_incremental_scans(store, 'unanalyzed_media', progresses, {
+            'succeeded': [(item.library_name, item.media_item_id) for item in dispatch_results['succeeded_items']],
+            'failed': [(item.library_name, item.media_item_id) for item in dispatch_results['failed']] + rejected_ids,
+            'skipped': skipped_ids,
+        }, advance_marks=not dispatch_results['stopped'])
+    if run_id is not None:
+        store.finish_run(run_id)
+    if store:
+        store.close()
+
+    if preflight:
+        logger.info(f"Checked {sum(preflight_counts.values())} files: {preflight_counts['analyzable']} analyzable, "
+                    f"{preflight_counts['missing']} missing, {preflight_counts['size_mismatch']} with a size mismatch")
+        if preflight_counts['missing'] and preflight_counts['missing'] == sum(preflight_counts.values()):
+            logger.warning("None of the files were found, check preflight.path_mappings and the mounts")
+
+    if not found_items:
+        logger.info(f"There were no media items without analysis in {describe_libraries(library_names)}")
+        sys.exit(0)
+
+    for library_name in library_names:
+        if found_items[library_name]:
+            logger.info(f"Found {found_items[library_name]} media items without analysis in library: "
+                        f"{library_name!r}")
+
+    logger.info(f"Finished analyzing {dispatch_results['succeeded']} media items in "
+                f"{dispatch.format_duration(dispatch_results['elapsed'])}, "
+                f"{len(dispatch_results['failed'])} failed")
+    for item in dispatch_results['failed']:
+        logger.warning(f"Media analysis failed for: {item.file}")
+    if dispatch_results['stopped']:
+        logger.warning("Stopped before all media items were analyzed, the time budget is spent")
 
     logger.info("Finished")
     sys.exit(0)
@@ -149,53 +615,131 @@ def unanalyzed_media(library, auto_mode):
 @app.command(help='Find missing posters')
 @click.option(
     '-l', '--library',
-    help='Library to search for missing posters', required=True)
+    multiple=True,
+    help='Library to search for missing posters, can be given multiple times')
+@click.option('--all-libraries', is_flag=True, default=False, help='Search every movie and show library')
 @click.option('--auto-mode', '-a', required=False, default='0', help='Automatically perform specific action')
-def missing_posters(library, auto_mode):
-    global cfg
+@click.option('--incremental', is_flag=True, default=False,
+              help='Only scan items added since the last incremental scan, and retry previously failed items')
+@click.option('--resume', is_flag=True, default=False,
+              help='Queue the items in the state database, resuming the queue of an interrupted run')
+@click.option('--max-duration', callback=parse_duration_option,
+              help='Stop refreshing items after this long, e.g. 90m or 2h')
+@click.option('--allowed-hours', callback=parse_allowed_hours_option,
+              help='Only refresh items during these local hours, e.g. 1-6 or 22-6,12-14')
+@click.option('--section-refresh/--no-section-refresh', default=True, show_default=True,
+              help='Refresh whole libraries with many missing posters at once, see section_refresh')
+@click.option('--output', 'output_format', type=click.Choice(output.FORMATS),
+              help='Write the found items to a file instead of showing them, items are not prompted for')
+@click.option('--output-path', help='File the found items are written to, defaults to <command>.<format>')
+def missing_posters(library, all_libraries, auto_mode, incremental, resume, max_duration, allowed_hours,
+                    section_refresh, output_format, output_path):
+    from tabulate import tabulate
+
+    check_scan_options(auto_mode, incremental, resume)
+    libraries = resolve_libraries(library, all_libraries)
+    library_names = [section['name'] for section in libraries]
+
+    # pace every refresh, section refreshes included
+    scan_scheduler = get_scheduler(1, max_duration=max_duration, allowed_hours=allowed_hours)
 
     # retrieve items with missing posters
-    results = plex.metadata.find_items_missing_posters(cfg.plex.database_path, library)
+    store = progresses = run_id = None
+    if incremental:
+        store = get_state_store()
+        results, progresses = find_incremental_libraries_items(
+            store, 'missing_posters', library_names,
+            functools.partial(plex.metadata.find_items_missing_posters, database_path),
+            item_mark=plex.metadata.missing_poster_mark, item_id=lambda item: item.id)
+    elif resume:
+        store = get_state_store()
+        run_id = store.start_run('missing_posters')
+        results = find_queued_items(
+            store, 'missing_posters', library_names,
+            lambda: plex.metadata.find_libraries_items_missing_posters(database_path, libraries),
+            plex.metadata.MissingPosterItem, item_id=lambda item: item.id)
+    else:
+        # coalesce the refreshes of libraries with many missing posters into section refreshes
+        refreshed_sections = {}
+        if section_refresh and auto_mode == '1':
+            planned = plan_section_refreshes(libraries)
+            for section in libraries:
+                if section['name'] not in planned or not scan_scheduler.wait_until_ready():
+                    continue
+                if plex.actions.refresh_section_metadata(cfg, section['id']):
+                    refreshed_sections[section['name']] = planned[section['name']]
+
+        results = plex.metadata.find_libraries_items_missing_posters(
+            database_path, [section for section in libraries if section['name'] not in refreshed_sections])
+
+        # verify the section refreshes through the database, refreshing the items still missing a poster
+        def section_leftovers():
+            for section in libraries:
+                if section['name'] not in refreshed_sections:
+                    continue
+
+                remaining = wait_for_section_refresh(section, refreshed_sections[section['name']])
+                logger.info(f"Section refresh of library {section['name']!r} fixed "
+                            f"{refreshed_sections[section['name']] - (remaining or 0)} of "
+                            f"{refreshed_sections[section['name']]} items with a missing poster")
+                if remaining:
+                    yield from plex.metadata.find_libraries_items_missing_posters(cfg.plex.database_path,
+                                                                                  [section]) or ()
+
+        if results is not None and refreshed_sections:
+            results = itertools.chain(results, section_leftovers())
     if results is None:
-        logger.error(f"Failed to find missing posters for library: {library!r}")
+        logger.error(f"Failed to find missing posters for {describe_libraries(library_names)}")
         sys.exit(1)
 
-    if not results:
-        logger.info(f"There were no items with missing posters in library: {library!r}")
-        sys.exit(0)
+    writer = None
+    if output_format:
+        writer = open_output(output_format, output_path, 'missing_posters', plex.metadata.MissingPosterItem._fields,
+                             plex.metadata.MISSING_POSTER_ITEM_TYPES)
 
-    logger.info(f"Found {len(results)} items with missing posters in the library: {library!r}")
+    # process found items, results are streamed so work starts on the first row
+    found_items = collections.Counter()
+    outcomes = {'succeeded': [], 'failed': [], 'skipped': []}
 
-    # process found items
-    for item in results:
-        if 'title' not in item or 'id' not in item:
-            logger.debug(f"Skipping item as there was no title or metadata_item_id found: {item}")
-            continue
+    def record_outcome(item, status):
+        # only the ids are kept, and only when the incremental scan records them
+        if progresses is not None:
+            outcomes[status].append((item.library_name, item.id))
 
-        # build table data for this item
-        table_data = [
-            # Library
-            ['Library', item['library_name'] if misc.valid_dict_item(item, 'library_name') else '']
-            # Metadata Item ID
-            , ['ID', item['id']]
-            # GUID
-            , ['GUID', item['guid'] if misc.valid_dict_item(item, 'guid') else '']
-            # Poster
-            , ['Poster', item['user_thumb_url'] if misc.valid_dict_item(item, 'user_thumb_url') else '']
-            # Added date
-            , ['Added', item['added_at'] if misc.valid_dict_item(item, 'added_at') else '']
-        ]
+    # only pace the items refreshed without asking, listing and prompting are never held back
+    for item in scan_scheduler.iter_ready(results) if auto_mode == '1' else results:
+        found_items[item.library_name] += 1
+
+        if writer is not None:
+            writer.write(item)
+        else:
+            # build table data for this item
+            table_data = [
+                # Library
+                ['Library', item.library_name or '']
+                # Metadata Item ID
+                , ['ID', item.id]
+                # GUID
+                , ['GUID', item.guid or '']
+                # Poster
+                , ['Poster', item.user_thumb_url or '']
+                # Added date
+                , ['Added', item.added_at or '']
+            ]
 
-        # show user information
-        logger.info(f"Item with missing poster, {item['title']} "
-                    f"({item['year'] if misc.valid_dict_item(item, 'year') else '????'}):"
-                    f"\n{tabulate(table_data)}")
+            # show user information
+            logger.info(f"Item with missing poster, {item.title} ({item.year or '????'}):\n{tabulate(table_data)}")
 
-        if auto_mode == '0':
+        if auto_mode == '0' and writer is not None:
+            # only report the item
+            record_outcome(item, 'skipped')
+            continue
+        elif auto_mode == '0':
             # ask user what to-do
             logger.info("What would you like to-do with this item? (0 = skip, 1 = refresh)")
             user_input = input()
             if user_input is None or user_input == '0':
+                record_outcome(item, 'skipped')
                 continue
         else:
             # user the determined auto mode
@@ -205,10 +749,301 @@ def missing_posters(library, auto_mode):
         if user_input == '1':
             # do refresh
             logger.debug("Refreshing metadata...")
-            if plex.actions.refresh_item_metadata(cfg, item['id']):
+            if plex.actions.refresh_item_metadata(cfg, item.id):
                 logger.info("Refreshed metadata!")
+                record_outcome(item, 'succeeded')
+                status = 'done'
             else:
-                continue
+                record_outcome(item, 'failed')
+                status = 'failed'
+        else:
+            record_outcome(item, 'skipped')
+            status = 'skipped'
+
+        # checkpoint the queued item
+        if run_id is not None:
+            store.complete_queued('missing_posters', item.library_name, item.id, run_id, status)
+
+    if writer is not None:
+        writer.close()
+    if progresses is not None:
+        # the item taken when the time budget ran out was never refreshed, so keep the marks of a stopped scan
+        finish_incremental_scans(store, 'missing_posters', progresses, outcomes,
+                                 advance_marks=not scan_scheduler.stopped)
+    if run_id is not None:
+        store.finish_run(run_id)
+    if store:
+        store.close()
+
+    if not found_items:
+        logger.info(f"There were no items with missing posters in {describe_libraries(library_names)}")
+        sys.exit(0)
+
+    for library_name in library_names:
+        if found_items[library_name]:
+            logger.info(f"Found {found_items[library_name]} items with missing posters in the library: "
+                        f"{library_name!r}")
+    if scan_scheduler.stopped:
+        logger.warning("Stopped before all items were refreshed, the time budget is spent")
+    logger.info("Finished")
+    sys.exit(0)
+
+
+@app.command(help='Show the queue depth and throughput of resumable runs')
+def status():
+    from tabulate import tabulate
+
+    store = get_state_store()
+    queue_status = store.get_queue_status()
+    last_runs = store.get_last_runs()
+    store.close()
+
+    if not queue_status and not last_runs:
+        logger.info("There are no queued items")
+        sys.exit(0)
+
+    # queue depth per scan and library
+    queue_table = {}
+    for row in queue_status:
+        counts = queue_table.setdefault((row['scan'], row['library']), {'waiting': 0})
+        counts[row['status']] = row['items']
+        if row['status'] in ('done', 'failed'):
+            counts['waiting'] += row['waiting']
+
+    table_data = [[scan, library, counts.get('pending', 0), counts.get('done', 0), counts.get('failed', 0),
+                   counts.get('skipped', 0), counts['waiting']]
+                  for (scan, library), counts in queue_table.items()]
+    logger.info("Queue:\n" + tabulate(table_data, headers=['Scan', 'Library', 'Pending', 'Done', 'Failed',
+                                                           'Skipped', 'Waiting']))
+
+    # throughput of the last run of every scan
+    def format_time(timestamp):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp else ''
+
+    table_data = []
+    for run in last_runs:
+        elapsed = (run['finished_at'] or run['last_progress_at'] or run['started_at']) - run['started_at']
+        table_data.append([run['scan'], format_time(run['started_at']), format_time(run['finished_at']),
+                           run['items'], run['done'], run['failed'], dispatch.format_duration(elapsed),
+                           f"{run['items'] / elapsed:.2f}" if elapsed else ''])
+    logger.info("Last runs:\n" + tabulate(table_data, headers=['Scan', 'Started', 'Finished', 'Items', 'Done',
+                                                               'Failed', 'Elapsed', 'Items/s']))
+
+    sys.exit(0)
+
+
+@app.command(help='Report the health of libraries in a single pass over the database')
+@click.option(
+    '-l', '--library',
+    multiple=True,
+    help='Library to report on, can be given multiple times')
+@click.option('--all-libraries', is_flag=True, default=False, help='Report on every movie and show library')
+@click.option('--output', 'output_format', type=click.Choice(output.FORMATS),
+              help='Also write the report to a file')
+@click.option('--output-path', help='File the report is written to, defaults to library_report.<format>')
+def library_report(library, all_libraries, output_format, output_path):
+    from tabulate import tabulate
+
+    libraries = resolve_libraries(library, all_libraries)
+    library_names = [section['name'] for section in libraries]
+
+    started = time.monotonic()
+    report = plex.report.get_libraries_report(database_path, libraries)
+    if report is None:
+        logger.error(f"Failed to build the health report of {describe_libraries(library_names)}")
+        sys.exit(1)
+    logger.debug(f"Built the health report in {dispatch.format_duration(time.monotonic() - started)}")
+
+    headers = ['Library', 'Items', 'Missing posters', 'Missing years', 'Missing guids', 'Parts', 'Unanalyzed',
+               'Zero size parts']
+    table_data = [[library_name] + row for library_name, row in zip(report.index, report.values.tolist())]
+    if len(table_data) > 1:
+        table_data.append(['Total'] + report.sum().tolist())
+    logger.info("Library health:\n" + tabulate(table_data, headers=headers))
+
+    if output_format:
+        columns = plex.report.REPORT_COLUMNS
+        writer = open_output(output_format, output_path, 'library_report', ['library_name'] + columns,
+                             dict.fromkeys(columns, int))
+        for library_name, row in zip(report.index, report.values.tolist()):
+            writer.write([library_name] + row)
+        writer.close()
+
+    sys.exit(0)
+
+
+@app.command(help='Find duplicate media files, and media items sharing a guid')
+@click.option(
+    '-l', '--library',
+    multiple=True,
+    help='Library to search for duplicates, can be given multiple times')
+@click.option('--all-libraries', is_flag=True, default=False, help='Search every movie and show library')
+@click.option('--by', 'matches', type=click.Choice(['files', 'guid']), multiple=True, default=['files', 'guid'],
+              show_default=True, help='Match duplicate files by size and hash, or media items by guid')
+@click.option('--match-hash/--no-match-hash', default=True, show_default=True,
+              help='Match duplicate files on their hash as well as their size')
+@click.option('--output', 'output_format', type=click.Choice(output.FORMATS),
+              help='Write the duplicate parts to a file instead of showing them')
+@click.option('--output-path', help='File the duplicate parts are written to, defaults to duplicates.<format>')
+def duplicates(library, all_libraries, matches, match_hash, output_format, output_path):
+    from tabulate import tabulate
+
+    libraries = resolve_libraries(library, all_libraries)
+    library_names = [section['name'] for section in libraries]
+
+    # run the query of every match up front to catch a failing query
+    match_results = []
+    for match in dict.fromkeys(matches):
+        if match == 'files':
+            results = plex.metadata.find_libraries_duplicate_files(database_path, libraries, match_hash=match_hash)
+        else:
+            results = plex.metadata.find_libraries_duplicate_guids(database_path, libraries)
+        if results is None:
+            logger.error(f"Failed to find duplicate {match} in {describe_libraries(library_names)}")
+            sys.exit(1)
+        match_results.append(results)
+
+    writer = None
+    if output_format:
+        writer = open_output(output_format, output_path, 'duplicates', plex.metadata.DuplicatePart._fields,
+                             plex.metadata.DUPLICATE_PART_TYPES)
+
+    # groups are streamed in order of their key, so only one group is held at a time
+    found_groups = collections.Counter()
+    found_files = collections.Counter()
+    reclaimable = collections.Counter()
+    for group in plex.metadata.iter_duplicate_groups(itertools.chain.from_iterable(match_results)):
+        match = group[0].match
+        found_groups[match] += 1
+        # a file of several libraries or media parts is only on disk once
+        file_sizes = {part.file: part.size or 0 for part in group}
+        found_files[match] += len(file_sizes)
+        # keeping the largest file of the group
+        sizes = list(file_sizes.values())
+        reclaimable[match] += sum(sizes) - max(sizes)
+
+        if writer is not None:
+            for part in group:
+                writer.write(part)
+            continue
+
+        if match == 'files':
+            description = f"{len(file_sizes)} files of {misc.format_size(group[0].size)}"
+        else:
+            description = f"{len(file_sizes)} files of {group[0].title!r} ({group[0].key})"
+        table_data = [[part.library_name, part.title, part.file, misc.format_size(part.size or 0),
+                       part.bitrate or ''] for part in group]
+        logger.info(f"Duplicate {description}:\n" +
+                    tabulate(table_data, headers=['Library', 'Title', 'File', 'Size', 'Bitrate']))
+
+    if writer is not None:
+        writer.close()
+
+    if not found_groups:
+        logger.info(f"There were no duplicates in {describe_libraries(library_names)}")
+        sys.exit(0)
+
+    for match in found_groups:
+        logger.info(f"Found {found_groups[match]} groups of duplicate {match} with {found_files[match]} files, "
+                    f"{misc.format_size(reclaimable[match])} reclaimable keeping the largest file of every group")
+    logger.info("Finished")
+    sys.exit(0)
+
+
+@app.command(help='Watch the Plex database and act on new unanalyzed media and missing posters')
+@click.option(
+    '-l', '--library',
+    multiple=True,
+    help='Library to watch, can be given multiple times'
+)
+@click.option('--all-libraries', is_flag=True, default=False, help='Watch every movie and show library')
+@click.option(
+    '--interval',
+    type=click.FloatRange(min=0.1), default=10, show_default=True,
+    help='Seconds between checks of the database for changes'
+)
+@click.option('--analyze/--no-analyze', default=True, show_default=True, help='Analyze new unanalyzed media items')
+@click.option('--refresh-posters/--no-refresh-posters', default=True, show_default=True,
+              help='Refresh new items with missing posters')
+@click.option(
+    '-c', '--concurrency',
+    type=click.IntRange(min=1), default=1, show_default=True,
+    help='Number of analyze and refresh requests to run concurrently'
+)
+@click.option('--adaptive', is_flag=True, default=False,
+              help='Adapt the concurrency, up to --concurrency, to the latency and error rate of the server')
+@click.option('--allowed-hours', callback=parse_allowed_hours_option,
+              help='Only act on items during these local hours, e.g. 1-6 or 22-6,12-14')
+def watch(library, all_libraries, interval, analyze, refresh_posters, concurrency, adaptive, allowed_hours):
+    # a snapshot never changes, so always watch the live database
+    watch_database_path = cfg.plex.database_path
+    if database_path != watch_database_path:
+        logger.warning(f"Ignoring the snapshot, watching the Plex database: {watch_database_path!r}")
+
+    library_names = [section['name'] for section in resolve_libraries(library, all_libraries)]
+
+    def analyze_item(item):
+        logger.debug(f"Analyzing metadata for: {item.file}")
+        if plex.actions.analyze_metadata_item(cfg, item.metadata_item_id):
+            logger.info(f"Media analysis successful for: {item.file}")
+            return True
+        return False
+
+    def refresh_item(item):
+        logger.debug(f"Refreshing metadata for: {item.title} ({item.year or '????'})")
+        if plex.actions.refresh_item_metadata(cfg, item.id):
+            logger.info(f"Refreshed metadata for: {item.title} ({item.year or '????'})")
+            return True
+        return False
+
+    # build the scans to run on every change
+    scans = []
+    for library_name in library_names:
+        if analyze:
+            scans.append(dict(
+                scan='unanalyzed_media', library=library_name,
+                find_items=lambda library_name=library_name, **filters: plex.metadata.find_items_unanalyzed(
+                    watch_database_path, library_name, **filters),
+                item_mark=plex.metadata.unanalyzed_mark, item_id=lambda item: item.media_item_id,
+                action=analyze_item, describe=lambda item: item.file))
+        if refresh_posters:
+            scans.append(dict(
+                scan='missing_posters', library=library_name,
+                find_items=lambda library_name=library_name, **filters: plex.metadata.find_items_missing_posters(
+                    watch_database_path, library_name, **filters),
+                item_mark=plex.metadata.missing_poster_mark, item_id=lambda item: item.id,
+                action=refresh_item, describe=lambda item: f"{item.title} ({item.year or '????'})"))
+
+    if not scans:
+        logger.error("There is nothing to watch with both --no-analyze and --no-refresh-posters")
+        sys.exit(1)
+
+    if sql.get_data_version(watch_database_path) is None:
+        logger.error(f"Failed to read the Plex database: {watch_database_path!r}")
+        sys.exit(1)
+
+    store = get_state_store()
+    scan_scheduler = get_scheduler(concurrency, adaptive=adaptive, allowed_hours=allowed_hours)
+    logger.info(f"Watching {len(library_names)} libraries for changes every {interval}s")
+    last_data_version = None
+    try:
+        while True:
+            # data_version only changes when the Plex Media Server commits, so idle checks never touch the tables
+            data_version = sql.get_data_version(watch_database_path)
+            if data_version is not None and data_version != last_data_version:
+                logger.debug(f"Database changed, data_version: {data_version}")
+                last_data_version = data_version
+
+                # wait for the allowed hours before scanning, so no read is held open while paused
+                scan_scheduler.wait_until_ready()
+                for scan in scans:
+                    run_watch_scan(store, concurrency=concurrency, scan_scheduler=scan_scheduler, **scan)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        store.close()
 
     logger.info("Finished")
     sys.exit(0)
@@ -226,11 +1061,23 @@ def missing_posters(library, auto_mode):
     '-s', '--sheets-id',
     help='Cloudbox Sheets Collection ID', required=False
 )
-def create_update_collection(library, tmdb_id, sheets_id):
+@click.option('--refresh-cache', is_flag=True, default=False, help='Bypass cached Tmdb responses and refresh them')
+@click.option(
+    '-b', '--batch-size',
+    type=click.IntRange(min=1), default=50, show_default=True,
+    help='Number of items to add to the collection per request'
+)
+def create_update_collection(library, tmdb_id, sheets_id, refresh_cache, batch_size):
     if not tmdb_id and not sheets_id:
         logger.error("You must specify either a Tmdb ID or a Sheets ID!")
         sys.exit(1)
 
+    from utils import themoviedb
+
+    # init tmdb cache
+    cache_path = cfg.tmdb.cache_path or os.path.join(config_dir, 'tmdb_cache.db')
+    themoviedb.init_cache(cache_path, cfg.tmdb.cache_ttl, cfg.tmdb.cache_max_entries, refresh=refresh_cache)
+
     if tmdb_id:
         logger.info(f"Retrieving details for Tmdb collection: {tmdb_id!r}")
 
@@ -244,48 +1091,59 @@ def create_update_collection(library, tmdb_id, sheets_id):
             f"Retrieved collection details: {collection_details['name']!r}, {len(collection_details['parts'])} parts")
     else:
         logger.info(f"Retrieving details for Sheets collection: {sheets_id!r}")
+        from utils import sheets
         collection_details = sheets.get_sheets_collection(sheets_id)
 
-    # iterate collection items assigning them to the collection
-    for item in collection_details['parts']:
-        # try to find item by imdb guid
-        plex_item_details = plex.metadata.get_metadata_item_by_guid(cfg.plex.database_path, library,
-                                                                    f"com.plexapp.agents.imdb://{item['imdb_id']}"
-                                                                    f"?lang=en")
-        if not plex_item_details:
-            # fallback to tmdb guid
-            plex_item_details = plex.metadata.get_metadata_item_by_guid(cfg.plex.database_path, library,
-                                                                        f"com.plexapp.agents.themoviedb://"
-                                                                        f"{item['tmdb_id']}?lang=en")
+    # resolve all collection items in the library at once
+    plex_items = plex.metadata.resolve_collection_parts(database_path, library, collection_details['parts'])
+    if plex_items is None:
+        logger.error(f"Failed to lookup collection items in library: {library!r}")
+        sys.exit(1)
 
-        if not plex_item_details or not misc.dict_contains_keys(plex_item_details, ['id', 'guid', 'title', 'year']):
+    # find the plex items of the collection
+    collection_items = {}
+    for part_index, item in enumerate(collection_details['parts']):
+        plex_item_details = plex_items.get(part_index)
+        if not plex_item_details:
             logger.warning(
                 f"Failed to find collection item in library: {library!r} - {item['title']}: {json.dumps(item)}")
             continue
 
-        # we have a plex item, lets assign it to the category
         logger.debug(
-            f"Adding {plex_item_details['title']} ({plex_item_details['year']}) to collection: "
+            f"Adding {plex_item_details.title} ({plex_item_details.year}) to collection: "
             f"{collection_details['name']!r}")
+        collection_items[plex_item_details.id] = plex_item_details
 
-        if plex.actions.set_metadata_item_collection(cfg, plex_item_details['id'], collection_details['name']):
+    # we have the plex items, lets assign them to the collection in batches
+    added_item_ids = set(plex.actions.set_metadata_items_collection(cfg, collection_items.values(),
+                                                                    collection_details['name'], chunk_size=batch_size))
+    for plex_item_details in collection_items.values():
+        if plex_item_details.id in added_item_ids:
             logger.info(
-                f"Added {plex_item_details['title']} ({plex_item_details['year']}) to collection: "
+                f"Added {plex_item_details.title} ({plex_item_details.year}) to collection: "
                 f"{collection_details['name']!r}")
-            time.sleep(2)
         else:
             logger.error(
-                f"Failed adding {plex_item_details['title']} ({plex_item_details['year']}) to collection: "
+                f"Failed adding {plex_item_details.title} ({plex_item_details.year}) to collection: "
                 f"{collection_details['name']!r}")
-            sys.exit(1)
 
-    # locate collection in database
-    logger.info("Sleeping 10 seconds before attempting to locate the collection in database")
-    time.sleep(10)
+    if len(added_item_ids) != len(collection_items):
+        sys.exit(1)
+
+    # wait for the collection tags to land in the database
+    def items_tagged():
+        tagged_item_ids = plex.metadata.get_collection_tagged_item_ids(cfg.plex.database_path,
+                                                                       collection_details['name'], added_item_ids)
+        return tagged_item_ids is not None and len(tagged_item_ids) >= len(added_item_ids)
+
+    logger.info("Waiting for the collection items to be tagged in the database")
+    if not misc.wait_for(items_tagged):
+        logger.warning(f"Timed out waiting for all collection items to be tagged with: {collection_details['name']!r}")
 
     # lookup collection metadata_item_id
-    collection_metadata = plex.metadata.get_metadata_item_of_collection(cfg.plex.database_path, library,
-                                                                        collection_details['name'])
+    logger.info("Waiting for the collection to appear in the database")
+    collection_metadata = misc.wait_for(lambda: plex.metadata.get_metadata_item_of_collection(
+        cfg.plex.database_path, library, collection_details['name']))
     if not collection_metadata or not misc.dict_contains_keys(collection_metadata, ['id', 'guid']):
         logger.error(
             f"Failed to find collection in the Plex library {library!r} with name: {collection_details['name']!r}")
@@ -299,10 +1157,17 @@ def create_update_collection(library, tmdb_id, sheets_id):
 
         logger.info(f"Updated collection poster to: {collection_details['poster_url']!r}")
 
+        # wait for the poster change to be committed before the next update
+        def poster_updated():
+            result = plex.metadata.get_metadata_item_id(cfg.plex.database_path, collection_metadata['id'])
+            return result and result.get('user_thumb_url') != collection_metadata['user_thumb_url']
+
+        # an unchanged poster url may never change user_thumb_url, so never wait longer than the old fixed delay
+        if not misc.wait_for(poster_updated, timeout=5):
+            logger.debug("Timed out waiting for the collection poster update to land in the database")
+
     # set overview
     if collection_details['overview']:
-        logger.info("Sleeping 5 seconds before setting collection summary")
-        time.sleep(5)
         if not plex.actions.set_metadata_item_summary(cfg, collection_metadata['id'], collection_details['overview']):
             logger.error(f"Failed setting collection summary to: {collection_details['overview']!r}")
             sys.exit(1)
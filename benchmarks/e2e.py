@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+End to end throughput benchmark of the cli commands against a synthetic database and the fake Plex server.
+
+Each scenario runs app.py in a subprocess with a generated config, reporting its wall time, the requests the
+fake server received and the items it processed per second, as json.
+
+    python benchmarks/e2e.py --items 50000 --latency 0.05 --concurrency 1 --concurrency 8
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import fake_plex  # noqa: E402
+import synthetic_db  # noqa: E402
+
+from utils.cache import Cache  # noqa: E402
+from utils.config import Config  # noqa: E402
+
+BENCHMARK_COLLECTION_ID = 1
+BENCHMARK_COLLECTION_SIZE = 100
+
+
+def write_config(config_path, database_path, plex_url, pool_size):
+    config = json.loads(json.dumps(Config.base_config))
+    config['plex'].update({'database_path': database_path, 'url': plex_url, 'token': 'benchmark',
+                           'pool_size': pool_size})
+    # never expire the pre-seeded tmdb cache, the benchmark runs offline
+    config['tmdb']['cache_ttl'] = 0
+    with open(config_path, 'w') as fp:
+        json.dump(config, fp, indent=2)
+
+
+def seed_tmdb_cache(cache_path, database_path):
+    """Seed the tmdb cache with a collection made of movies of the synthetic database"""
+    with closing(sqlite3.connect(database_path)) as conn:
+        movies = conn.execute("SELECT id, title FROM metadata_items WHERE metadata_type = 1 "
+                              "AND guid LIKE 'com.plexapp.agents.themoviedb://%' AND library_section_id = 1 "
+                              "LIMIT ?", [BENCHMARK_COLLECTION_SIZE]).fetchall()
+
+    cache = Cache(cache_path, ttl=0, max_entries=0)
+    cache.set('collection', BENCHMARK_COLLECTION_ID, {
+        'id': BENCHMARK_COLLECTION_ID,
+        'name': 'Benchmark Collection',
+        'overview': 'Synthetic benchmark collection',
+        'poster_path': '/benchmark.jpg',
+        'parts': [{'id': movie_id, 'title': title} for movie_id, title in movies],
+    })
+    for movie_id, title in movies:
+        cache.set('movie', movie_id, {'id': movie_id, 'imdb_id': None, 'title': title})
+    cache.close()
+    return len(movies)
+
+
+def run_scenario(name, args, work_dir, template_path, plex_options, pool_size, timeout):
+    # every scenario starts from a pristine copy of the database
+    database_path = os.path.join(work_dir, 'plex.db')
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+    shutil.copyfile(template_path, database_path)
+    fake = fake_plex.FakePlex(database_path=database_path, **plex_options)
+    server = fake_plex.start_server(fake)
+
+    config_path = os.path.join(work_dir, 'config.json')
+    write_config(config_path, database_path, server.url, pool_size)
+    seed_tmdb_cache(os.path.join(work_dir, 'tmdb_cache.db'), database_path)
+
+    command = [sys.executable, os.path.join(REPO_PATH, 'app.py'), '--config-path', config_path,
+               '--log-path', os.path.join(work_dir, 'activity.log')] + args
+    started = time.monotonic()
+    proc = subprocess.run(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=timeout)
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    stats = fake.stats()
+    items = sum(route['items'] for route in stats['routes'].values())
+    return {
+        'scenario': name,
+        'command': args,
+        'exit_code': proc.returncode,
+        'seconds': round(elapsed, 3),
+        'requests': stats['requests'],
+        'items': items,
+        'items_per_second': round(items / elapsed, 2) if elapsed else None,
+        'max_in_flight': stats['max_in_flight'],
+        'routes': stats['routes'],
+        'stderr': proc.stderr[-2000:] if proc.returncode else '',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of the cli commands')
+    parser.add_argument('--items', type=int, default=20000, help='Metadata items of the synthetic database')
+    parser.add_argument('--library', default='Movies 1', help='Library the commands run against')
+    parser.add_argument('--latency', type=float, default=0.02, help='Fake Plex response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Fake Plex latency jitter in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fake Plex share of failing requests')
+    parser.add_argument('--server-concurrency', type=int, default=0, help='Fake Plex concurrency cap')
+    parser.add_argument('--load-latency', type=float, default=0.0,
+                        help='Fake Plex latency added per other request in flight')
+    parser.add_argument('--concurrency', type=int, action='append', help='Analyze concurrency to benchmark')
+    parser.add_argument('--batch-size', type=int, action='append', help='Collection batch size to benchmark')
+    parser.add_argument('--pool-size', type=int, default=10, help='Plex client connection pool size')
+    parser.add_argument('--timeout', type=int, default=3600, help='Timeout of each scenario in seconds')
+    parser.add_argument('--output', help='Write json results to this file instead of stdout')
+    args = parser.parse_args()
+
+    plex_options = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                    'concurrency': args.server_concurrency, 'load_latency': args.load_latency, 'seed': 1}
+
+    scenarios = [('missing-posters', ['missing-posters', '-l', args.library, '-a', '1'])]
+    for concurrency in args.concurrency or [1, 8]:
+        scenarios.append((f"unanalyzed-media concurrency={concurrency}",
+                          ['unanalyzed-media', '-l', args.library, '-a', '1', '-c', str(concurrency)]))
+    max_concurrency = max(args.concurrency or [1, 8])
+    scenarios.append((f"unanalyzed-media adaptive concurrency<={max_concurrency}",
+                      ['unanalyzed-media', '-l', args.library, '-a', '1', '-c', str(max_concurrency), '--adaptive']))
+    for batch_size in args.batch_size or [1, 50]:
+        scenarios.append((f"create-update-collection batch-size={batch_size}",
+                          ['create-update-collection', '-l', args.library, '-i', str(BENCHMARK_COLLECTION_ID),
+                           '-b', str(batch_size)]))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        template_path = os.path.join(work_dir, 'template.db')
+        counts = synthetic_db.generate(template_path, items=args.items)
+
+        results = {
+            'synthetic': counts,
+            'fake_plex': plex_options,
+            'scenarios': [run_scenario(name, scenario_args, work_dir, template_path, plex_options, args.pool_size,
+                                       args.timeout) for name, scenario_args in scenarios],
+        }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+    return 0 if all(scenario['exit_code'] == 0 for scenario in results['scenarios']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Plex Media Server endpoints used by plex.actions.
+
+Requests are answered after a configurable latency, a share of them fail with a 500 and requests beyond the
+concurrency cap are rejected with a 503. With a load latency, every request in flight slows the others down, like
+a saturated server. Every request is recorded and available from GET /_requests.
+When a database is given, updates are applied to it the way Plex would, so readiness polling works.
+
+GET /status/sessions and /activities report the sessions, transcodes and activities set with
+PUT /_load?sessions=2&transcodes=1&activities=0.
+
+    python benchmarks/fake_plex.py --port 32400 --latency 0.05 --error-rate 0.01 --database /tmp/plex.db
+"""
+import argparse
+import json
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROUTES = [
+    ('PUT', re.compile(r'^/library/metadata/(\d+)/refresh$'), 'refresh'),
+    ('PUT', re.compile(r'^/library/metadata/(\d+)/analyze$'), 'analyze'),
+    ('PUT', re.compile(r'^/library/sections/(\d+)/all$'), 'update'),
+    ('POST', re.compile(r'^/library/metadata/(\d+)/posters$'), 'poster'),
+    ('GET', re.compile(r'^/library/sections/(\d+)/refresh$'), 'section_refresh'),
+]
+
+# share of the items of a refreshed section for which no poster is found
+SECTION_REFRESH_MISS_RATIO = 0.05
+
+
+class FakePlex(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, concurrency=0, database_path=None, seed=None,
+                 load_latency=0.0, sessions=0, transcodes=0, activities=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.load_latency = load_latency
+        self.load = {'sessions': sessions, 'transcodes': transcodes, 'activities': activities}
+        self.error_rate = error_rate
+        self.concurrency = concurrency
+        self.database_path = database_path
+        self.random = random.Random(seed)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.database_lock = threading.Lock()
+
+    def record(self, method, path, params, status, started):
+        with self.lock:
+            self.requests.append({
+                'method': method,
+                'path': path,
+                'params': params,
+                'status': status,
+                'started': started,
+                'elapsed': time.time() - started,
+            })
+
+    def stats(self):
+        with self.lock:
+            requests = list(self.requests)
+        by_route = {}
+        for request in requests:
+            route = by_route.setdefault(f"{request['method']} {route_name(request['method'], request['path'])}",
+                                        {'requests': 0, 'errors': 0, 'items': 0})
+            route['requests'] += 1
+            if request['status'] != 200:
+                route['errors'] += 1
+            else:
+                # section updates carry a comma separated list of item ids
+                route['items'] += len(request['params']['id'].split(',')) if 'id' in request['params'] else 1
+        return {'requests': len(requests), 'max_in_flight': self.max_in_flight, 'routes': by_route}
+
+    def status(self, path):
+        """Json body of the session and activity endpoints"""
+        with self.lock:
+            load = dict(self.load)
+        if path == '/status/sessions':
+            sessions = [{'type': 'movie', 'TranscodeSession': {}} if index < load['transcodes'] else {'type': 'movie'}
+                        for index in range(max(load['sessions'], load['transcodes']))]
+            return {'MediaContainer': {'size': len(sessions), 'Metadata': sessions}}
+        activities = [{'type': 'media.generate.analysis'} for _ in range(load['activities'])]
+        return {'MediaContainer': {'size': len(activities), 'Activity': activities}}
+
+    def apply(self, action, path_id, params):
+        """Apply an update to the database like the Plex Media Server would"""
+        if not self.database_path:
+            return
+
+        with self.database_lock, closing(sqlite3.connect(self.database_path, timeout=30)) as conn:
+            if action == 'analyze':
+                conn.execute("UPDATE media_items SET bitrate = ? WHERE metadata_item_id = ? AND bitrate IS NULL",
+                             [self.random.randint(1000000, 40000000), path_id])
+            elif action == 'refresh':
+                conn.execute("UPDATE metadata_items SET user_thumb_url = ? WHERE id = ?",
+                             [f"metadata://posters/refreshed_{path_id}", path_id])
+            elif action == 'poster':
+                conn.execute("UPDATE metadata_items SET user_thumb_url = ? WHERE id = ?",
+                             [f"upload://posters/{time.time()}", path_id])
+            elif action == 'update':
+                self.apply_section_update(conn, path_id, params)
+            elif action == 'section_refresh':
+                self.apply_section_refresh(conn, path_id)
+            conn.commit()
+
+    def apply_section_refresh(self, conn, section_id):
+        rows = conn.execute("SELECT id FROM metadata_items WHERE library_section_id = ? AND metadata_type IN (1, 2) "
+                            "AND (user_thumb_url = '' OR user_thumb_url LIKE 'media://%')", [section_id]).fetchall()
+        conn.executemany("UPDATE metadata_items SET user_thumb_url = ? WHERE id = ?",
+                         [(f"metadata://posters/refreshed_{row[0]}", row[0]) for row in rows
+                          if self.random.random() >= SECTION_REFRESH_MISS_RATIO])
+
+    @staticmethod
+    def apply_section_update(conn, section_id, params):
+        item_ids = [int(item_id) for item_id in params.get('id', '').split(',') if item_id]
+        if 'summary.value' in params:
+            conn.executemany("UPDATE metadata_items SET summary = ? WHERE id = ?",
+                             [(params['summary.value'], item_id) for item_id in item_ids])
+
+        collection_name = params.get('collection[0].tag.tag')
+        if not collection_name:
+            return
+
+        # find or create the collection tag and its collection item
+        tag = conn.execute("SELECT id FROM tags WHERE tag_type = 2 AND tag = ?", [collection_name]).fetchone()
+        tag_id = tag[0] if tag else conn.execute("INSERT INTO tags (tag, tag_type) VALUES (?, 2)",
+                                                 [collection_name]).lastrowid
+        if not conn.execute("SELECT 1 FROM metadata_items WHERE library_section_id = ? AND metadata_type = 18 "
+                            "AND title = ?", [section_id, collection_name]).fetchone():
+            conn.execute("INSERT INTO metadata_items (library_section_id, metadata_type, guid, title, user_thumb_url) "
+                         "VALUES (?, 18, ?, ?, '')", [section_id, f"collection://{tag_id}", collection_name])
+
+        conn.executemany("INSERT INTO taggings (metadata_item_id, tag_id) SELECT ?, ? WHERE NOT EXISTS ("
+                         "SELECT 1 FROM taggings WHERE metadata_item_id = ? AND tag_id = ?)",
+                         [(item_id, tag_id, item_id, tag_id) for item_id in item_ids])
+
+
+def route_name(method, path):
+    for route_method, pattern, name in ROUTES:
+        if route_method == method and pattern.match(path):
+            return name
+    return path
+
+
+def make_handler(fake):
+    class FakePlexHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json' if body else 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_action(self, method):
+            started = time.time()
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            # drain any request body so the connection can be kept alive
+            if int(self.headers.get('Content-Length') or 0):
+                self.rfile.read(int(self.headers['Content-Length']))
+
+            for route_method, pattern, action in ROUTES:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    break
+            else:
+                self.respond(404)
+                fake.record(method, url.path, params, 404, started)
+                return
+
+            # enforce the concurrency cap
+            with fake.lock:
+                if fake.concurrency and fake.in_flight >= fake.concurrency:
+                    over_capacity = True
+                else:
+                    over_capacity = False
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+            if over_capacity:
+                self.respond(503)
+                fake.record(method, url.path, params, 503, started)
+                return
+
+            try:
+                time.sleep(max(0.0, fake.latency + fake.random.uniform(-fake.jitter, fake.jitter)
+                               + fake.load_latency * (fake.in_flight - 1)))
+                if fake.random.random() < fake.error_rate:
+                    status = 500
+                else:
+                    fake.apply(action, int(match.group(1)), params)
+                    status = 200
+            finally:
+                with fake.lock:
+                    fake.in_flight -= 1
+
+            self.respond(status)
+            fake.record(method, url.path, params, status, started)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/_requests':
+                with fake.lock:
+                    body = json.dumps(fake.requests).encode()
+                self.respond(200, body)
+            elif url.path == '/_stats':
+                self.respond(200, json.dumps(fake.stats()).encode())
+            elif url.path in ('/status/sessions', '/activities'):
+                self.respond(200, json.dumps(fake.status(url.path)).encode())
+                fake.record('GET', url.path, {}, 200, time.time())
+            else:
+                self.handle_action('GET')
+
+        def do_PUT(self):
+            url = urlparse(self.path)
+            if url.path == '/_load':
+                with fake.lock:
+                    for key, values in parse_qs(url.query).items():
+                        if key in fake.load:
+                            fake.load[key] = int(values[-1])
+                self.respond(200)
+                return
+            self.handle_action('PUT')
+
+        def do_POST(self):
+            self.handle_action('POST')
+
+    return FakePlexHandler
+
+
+def start_server(fake, host='127.0.0.1', port=0):
+    """Start serving fake in a background thread, returns the server, its url is server.url"""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake Plex Media Server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=32400)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds taken to answer each request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with a 500')
+    parser.add_argument('--concurrency', type=int, default=0, help='Requests served at once, 0 is unlimited')
+    parser.add_argument('--load-latency', type=float, default=0.0,
+                        help='Seconds added to the latency for every other request in flight')
+    parser.add_argument('--sessions', type=int, default=0, help='Playing sessions reported')
+    parser.add_argument('--transcodes', type=int, default=0, help='Transcoding sessions reported')
+    parser.add_argument('--activities', type=int, default=0, help='Running activities reported')
+    parser.add_argument('--database', help='Database to apply updates to')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakePlex(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    concurrency=args.concurrency, database_path=args.database, seed=args.seed,
+                    load_latency=args.load_latency, sessions=args.sessions, transcodes=args.transcodes,
+                    activities=args.activities)
+    server = start_server(fake, args.host, args.port)
+    print(f"Fake Plex listening on {server.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(json.dumps(fake.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
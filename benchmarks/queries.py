@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Benchmark the plex.metadata and plex.report queries against a Plex database, by default a freshly generated synthetic
+one.
+
+Each query is run --runs times, reporting its timings, the peak python memory allocated while consuming its
+results, the number of rows and the EXPLAIN QUERY PLAN of every statement it ran, as json.
+
+    python benchmarks/queries.py --items 1000000 --output results.json
+    python benchmarks/queries.py --database /path/to/com.plexapp.plugins.library.db --library Movies
+"""
+import argparse
+import functools
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+from pathlib import Path
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import synthetic_db  # noqa: E402
+from loguru import logger  # noqa: E402
+
+import plex  # noqa: E402
+from utils import sql  # noqa: E402
+
+# statements run by the query currently being benchmarked
+captured_statements = []
+
+
+def capture_statements(func):
+    @functools.wraps(func)
+    def wrapper(database_path, query_str, query_args, *args, **kwargs):
+        captured_statements.append((query_str, list(query_args)))
+        return func(database_path, query_str, query_args, *args, **kwargs)
+
+    return wrapper
+
+
+def consume(result):
+    """Return the number of rows of a query function result, consuming it when it is a generator"""
+    if result is None:
+        return None
+    if hasattr(result, 'shape'):
+        # DataFrame reports, one row per library
+        return len(result)
+    if isinstance(result, (dict, tuple)) or not hasattr(result, '__iter__'):
+        return 1 if result else 0
+    return sum(1 for _ in result)
+
+
+def connect_read_only(database_path):
+    """Open database_path read-only, a --database may be the live Plex database"""
+    return sqlite3.connect(f"{Path(os.path.abspath(database_path)).as_uri()}?mode=ro", uri=True)
+
+
+def explain(database_path, statements):
+    plans = []
+    with closing(connect_read_only(database_path)) as conn:
+        for query_str, query_args in dict((query_str, (query_str, query_args))
+                                          for query_str, query_args in statements).values():
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {query_str}", query_args).fetchall()
+            plans.append({
+                'query': ' '.join(query_str.split()),
+                'plan': [row[3] for row in plan],
+            })
+    return plans
+
+
+def benchmark(database_path, name, func, runs):
+    timings = []
+    peak_memory = 0
+    rows = None
+    del captured_statements[:]
+
+    for _ in range(runs):
+        tracemalloc.start()
+        started = time.perf_counter()
+        rows = consume(func())
+        timings.append((time.perf_counter() - started) * 1000)
+        peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        'name': name,
+        'runs': runs,
+        'rows': rows,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'peak_memory_kb': round(peak_memory / 1024, 1),
+        'plans': explain(database_path, captured_statements),
+    }
+
+
+def pick_samples(database_path, library_name):
+    """Pick existing ids, guids and a collection of the library to look up"""
+    with closing(connect_read_only(database_path)) as conn:
+        items = conn.execute("""SELECT mi.id, mi.guid FROM metadata_items mi
+                                JOIN library_sections ls ON ls.id = mi.library_section_id
+                                WHERE ls.name = ? AND mi.metadata_type = 1
+                                ORDER BY mi.id LIMIT 500""", [library_name]).fetchall()
+        collection = conn.execute("""SELECT mi.title FROM metadata_items mi
+                                     JOIN library_sections ls ON ls.id = mi.library_section_id
+                                     WHERE ls.name = ? AND mi.metadata_type = 18 LIMIT 1""",
+                                  [library_name]).fetchone()
+    return items, collection[0] if collection else ''
+
+
+def run_benchmarks(database_path, library_name, runs):
+    items, collection_name = pick_samples(database_path, library_name)
+    libraries = plex.library.find_libraries(database_path, [library_name]) or []
+    all_libraries = plex.library.find_libraries(database_path) or []
+    guids = [guid for _, guid in items]
+    item_ids = [item[0] for item in items]
+    parts = [{'title': guid, 'imdb_id': guid.split('://')[1].split('?')[0] if 'imdb' in guid else None,
+              'tmdb_id': guid.split('://')[1].split('?')[0] if 'themoviedb' in guid else None}
+             for _, guid in items]
+
+    queries = [
+        ('find_library_type', lambda: plex.library.find_library_type(database_path, library_name)),
+        ('find_items_missing_posters', lambda: plex.metadata.find_items_missing_posters(database_path, library_name)),
+        ('find_items_unanalyzed', lambda: plex.metadata.find_items_unanalyzed(database_path, library_name)),
+        ('get_metadata_item_id', lambda: plex.metadata.get_metadata_item_id(
+            database_path, item_ids[-1] if item_ids else 0)),
+        ('get_metadata_item_by_guid', lambda: plex.metadata.get_metadata_item_by_guid(
+            database_path, library_name, items[-1][1] if items else '')),
+        ('resolve_collection_parts', lambda: list((plex.metadata.resolve_collection_parts(
+            database_path, library_name, parts) or {}).values())),
+        ('get_metadata_item_of_collection', lambda: plex.metadata.get_metadata_item_of_collection(
+            database_path, library_name, collection_name)),
+        ('get_collection_tagged_item_ids', lambda: plex.metadata.get_collection_tagged_item_ids(
+            database_path, collection_name, item_ids)),
+        ('find_libraries_items_missing_posters', lambda: plex.metadata.find_libraries_items_missing_posters(
+            database_path, all_libraries)),
+        ('count_libraries_items_missing_posters', lambda: plex.metadata.count_libraries_items_missing_posters(
+            database_path, all_libraries)),
+        ('find_libraries_items_unanalyzed', lambda: plex.metadata.find_libraries_items_unanalyzed(
+            database_path, all_libraries)),
+        ('count_libraries_items_unanalyzed', lambda: plex.metadata.count_libraries_items_unanalyzed(
+            database_path, all_libraries)),
+        ('count_libraries_items', lambda: plex.metadata.count_libraries_items(database_path, all_libraries)),
+        ('find_libraries_duplicate_files', lambda: plex.metadata.find_libraries_duplicate_files(
+            database_path, all_libraries)),
+        ('find_libraries_duplicate_guids', lambda: plex.metadata.find_libraries_duplicate_guids(
+            database_path, all_libraries)),
+        ('get_metadata_items_by_guids', lambda: plex.metadata.get_metadata_items_by_guids(
+            database_path, library_name, guids)),
+        ('get_libraries_report', lambda: plex.report.get_libraries_report(database_path, libraries)),
+        ('get_libraries_report_all', lambda: plex.report.get_libraries_report(database_path, all_libraries)),
+    ]
+
+    return [benchmark(database_path, name, func, runs) for name, func in queries]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plex.metadata queries')
+    parser.add_argument('--database', help='Database to benchmark, a synthetic database is generated when omitted')
+    parser.add_argument('--library', default='Movies 1', help='Library to run the queries against')
+    parser.add_argument('--items', type=int, default=100000, help='Metadata items of the synthetic database')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic database')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per query')
+    parser.add_argument('--output', help='Write json results to this file instead of stdout')
+    args = parser.parse_args()
+
+    logger.remove()
+
+    # capture the statements every query runs
+    sql.get_query_results = capture_statements(sql.get_query_results)
+    sql.get_query_result = capture_statements(sql.get_query_result)
+    sql.iter_query_results = capture_statements(sql.iter_query_results)
+    sql.iter_query_frames = capture_statements(sql.iter_query_frames)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = args.database
+        generated = None
+        if not database_path:
+            database_path = os.path.join(tmp_dir, 'plex_synthetic.db')
+            started = time.monotonic()
+            generated = synthetic_db.generate(database_path, items=args.items, seed=args.seed)
+            generated['seconds'] = round(time.monotonic() - started, 2)
+
+        results = {
+            'sqlite_version': sqlite3.sqlite_version,
+            'database': args.database or 'synthetic',
+            'synthetic': generated,
+            'library': args.library,
+            'queries': run_benchmarks(database_path, args.library, args.runs),
+        }
+        sql.close_databases()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
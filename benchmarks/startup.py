@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark of the plex_db_tools cli commands.
+
+Every command is run with representative options in a fresh interpreter with `python -X importtime`, against a
+synthetic database and the fake Plex server, so the modules it imports lazily, depending on its options, are
+measured as they are imported for real. The cumulative time of the top level imports is compared against the
+command's budget, exiting non-zero when any command is over budget.
+
+    python benchmarks/startup.py [--runs 5] [--budget unanalyzed-media=400] [--json]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import e2e  # noqa: E402
+import fake_plex  # noqa: E402
+import synthetic_db  # noqa: E402
+
+# arguments of each command, covering the options that import modules lazily, items are only reported
+COMMAND_ARGS = {
+    'unanalyzed-media': ['unanalyzed-media', '--all-libraries', '--output', 'jsonl'],
+    'unanalyzed-media --incremental --preflight': ['unanalyzed-media', '--all-libraries', '--incremental',
+                                                   '--preflight', '--output', 'jsonl'],
+    'unanalyzed-media --output parquet': ['unanalyzed-media', '--all-libraries', '--output', 'parquet'],
+    'missing-posters': ['missing-posters', '--all-libraries', '--output', 'jsonl'],
+    'missing-posters --resume': ['missing-posters', '--all-libraries', '--auto-mode', '2', '--resume'],
+    'status': ['status'],
+    'library-report': ['library-report', '--all-libraries'],
+    'library-report --output parquet': ['library-report', '--all-libraries', '--output', 'parquet'],
+    'duplicates': ['duplicates', '--all-libraries'],
+    'duplicates --output parquet': ['duplicates', '--all-libraries', '--output', 'parquet'],
+    'watch': ['watch', '--all-libraries', '--interval', '1'],
+    'create-update-collection': ['create-update-collection', '--library', 'Movies 1', '--tmdb-id',
+                                 str(e2e.BENCHMARK_COLLECTION_ID)],
+    'create-update-collection --sheets-id': ['create-update-collection', '--library', 'Movies 1', '--sheets-id',
+                                             'benchmark'],
+}
+
+# cold start budget of each command in milliseconds, about twice the imports measured on a typical machine
+DEFAULT_BUDGETS = {
+    'unanalyzed-media': 400,
+    'unanalyzed-media --incremental --preflight': 400,
+    'unanalyzed-media --output parquet': 1500,
+    'missing-posters': 400,
+    'missing-posters --resume': 400,
+    'status': 400,
+    'library-report': 1000,
+    'library-report --output parquet': 1500,
+    'duplicates': 400,
+    'duplicates --output parquet': 1500,
+    'watch': 400,
+    'create-update-collection': 400,
+    'create-update-collection --sheets-id': 1000,
+}
+
+# seconds a command may run, commands still running after it, like watch, are stopped
+COMMAND_TIMEOUT = 5
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def run_command(args, work_dir, config_path):
+    """Run app.py with args, returning the cumulative import time in milliseconds and its slowest imports"""
+    command = [sys.executable, '-X', 'importtime', os.path.join(REPO_PATH, 'app.py'), '--config-path', config_path,
+               '--log-path', os.path.join(work_dir, 'activity.log')] + args
+    # anything leaving the machine, like a sheets download, fails at once
+    env = dict(os.environ, HTTP_PROXY='http://127.0.0.1:9', HTTPS_PROXY='http://127.0.0.1:9', NO_PROXY='127.0.0.1')
+    proc = subprocess.Popen(command, cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        _, stderr = proc.communicate(timeout=COMMAND_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        _, stderr = proc.communicate()
+
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        # top level imports are indented by a single space, whether app.py or a command imports them
+        if match and len(match.group(3)) == 1:
+            imports.append((match.group(4), int(match.group(2)) / 1000))
+
+    total = sum(elapsed for _, elapsed in imports)
+    return total, sorted(imports, key=lambda item: item[1], reverse=True)[:5]
+
+
+def parse_budgets(budget_args):
+    budgets = dict(DEFAULT_BUDGETS)
+    for budget_arg in budget_args:
+        command, _, budget = budget_arg.rpartition('=')
+        if command not in COMMAND_ARGS:
+            raise SystemExit(f"Unknown command in budget: {command!r}")
+        budgets[command] = float(budget)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cold start import time of each command')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per command, the fastest run is reported')
+    parser.add_argument('--budget', action='append', default=[], metavar='COMMAND=MS',
+                        help='Override the import budget of a command in milliseconds')
+    parser.add_argument('--json', action='store_true', help='Print results as json')
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        database_path = os.path.join(work_dir, 'plex.db')
+        synthetic_db.generate(database_path, items=2000)
+        e2e.seed_tmdb_cache(os.path.join(work_dir, 'tmdb_cache.db'), database_path)
+
+        # the fake server answers without touching the database, so every run sees the same items
+        server = fake_plex.start_server(fake_plex.FakePlex())
+        config_path = os.path.join(work_dir, 'config.json')
+        e2e.write_config(config_path, database_path, server.url, 1)
+
+        for command, command_args in COMMAND_ARGS.items():
+            runs = [run_command(command_args, work_dir, config_path) for _ in range(args.runs)]
+            elapsed, slowest = min(runs, key=lambda run: run[0])
+            results.append({
+                'command': command,
+                'import_ms': round(elapsed, 1),
+                'budget_ms': budgets[command],
+                'within_budget': elapsed <= budgets[command],
+                'slowest_imports': [{'module': module, 'ms': round(ms, 1)} for module, ms in slowest],
+            })
+        server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            slowest = ', '.join(f"{item['module']} {item['ms']}ms" for item in result['slowest_imports'])
+            print(f"{'OK  ' if result['within_budget'] else 'OVER'} {result['command']:<40} "
+                  f"{result['import_ms']:>8.1f}ms / {result['budget_ms']:.0f}ms  ({slowest})")
+
+    return 0 if all(result['within_budget'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
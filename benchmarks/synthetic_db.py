@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic sqlite database with the parts of the Plex Media Server schema used by plex_db_tools.
+
+    python benchmarks/synthetic_db.py --items 100000 --output /tmp/plex_synthetic.db
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+# subset of the Plex schema, including the stock Plex indexes these tables have
+SCHEMA = """
+CREATE TABLE library_sections (
+    id INTEGER PRIMARY KEY
+    , library_id INTEGER
+    , name VARCHAR(255)
+    , name_sort VARCHAR(255)
+    , section_type INTEGER
+    , language VARCHAR(255)
+    , agent VARCHAR(255)
+    , scanner VARCHAR(255)
+    , created_at DATETIME
+    , updated_at DATETIME
+    , uuid VARCHAR(255)
+);
+CREATE TABLE metadata_items (
+    id INTEGER PRIMARY KEY
+    , library_section_id INTEGER
+    , parent_id INTEGER
+    , metadata_type INTEGER
+    , guid VARCHAR(255)
+    , title VARCHAR(255)
+    , title_sort VARCHAR(255)
+    , original_title VARCHAR(255)
+    , summary TEXT
+    , year INTEGER
+    , "index" INTEGER
+    , user_thumb_url VARCHAR(255)
+    , user_art_url VARCHAR(255)
+    , added_at DATETIME
+    , created_at DATETIME
+    , updated_at DATETIME
+);
+CREATE INDEX index_metadata_items_on_library_section_id ON metadata_items (library_section_id);
+CREATE INDEX index_metadata_items_on_parent_id ON metadata_items (parent_id);
+CREATE INDEX index_metadata_items_on_guid ON metadata_items (guid);
+CREATE INDEX index_metadata_items_on_title ON metadata_items (title);
+CREATE INDEX index_metadata_items_on_added_at ON metadata_items (added_at);
+CREATE INDEX index_metadata_items_on_metadata_type ON metadata_items (metadata_type);
+CREATE TABLE media_items (
+    id INTEGER PRIMARY KEY
+    , library_section_id INTEGER
+    , section_location_id INTEGER
+    , metadata_item_id INTEGER
+    , width INTEGER
+    , height INTEGER
+    , size INTEGER
+    , duration INTEGER
+    , bitrate INTEGER
+    , container VARCHAR(255)
+    , video_codec VARCHAR(255)
+    , audio_codec VARCHAR(255)
+    , created_at DATETIME
+    , updated_at DATETIME
+);
+CREATE INDEX index_media_items_on_library_section_id ON media_items (library_section_id);
+CREATE INDEX index_media_items_on_metadata_item_id ON media_items (metadata_item_id);
+CREATE TABLE media_parts (
+    id INTEGER PRIMARY KEY
+    , media_item_id INTEGER
+    , directory_id INTEGER
+    , hash VARCHAR(255)
+    , open_subtitle_hash VARCHAR(255)
+    , file VARCHAR(255)
+    , size INTEGER
+    , duration INTEGER
+    , created_at DATETIME
+    , updated_at DATETIME
+);
+CREATE INDEX index_media_parts_on_media_item_id ON media_parts (media_item_id);
+CREATE INDEX index_media_parts_on_file ON media_parts (file);
+CREATE INDEX index_media_parts_on_hash ON media_parts (hash);
+CREATE TABLE tags (
+    id INTEGER PRIMARY KEY
+    , metadata_item_id INTEGER
+    , tag VARCHAR(255)
+    , tag_type INTEGER
+    , created_at DATETIME
+    , updated_at DATETIME
+);
+CREATE INDEX index_tags_on_tag ON tags (tag);
+CREATE INDEX index_tags_on_tag_type ON tags (tag_type);
+CREATE TABLE taggings (
+    id INTEGER PRIMARY KEY
+    , metadata_item_id INTEGER
+    , tag_id INTEGER
+    , "index" INTEGER
+    , created_at DATETIME
+);
+CREATE INDEX index_taggings_on_metadata_item_id ON taggings (metadata_item_id);
+CREATE INDEX index_taggings_on_tag_id ON taggings (tag_id);
+"""
+
+INSERT_BATCH_SIZE = 10000
+
+
+def insert_rows(conn, table_name, columns, rows):
+    query_str = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            conn.executemany(query_str, batch)
+            batch = []
+    if batch:
+        conn.executemany(query_str, batch)
+
+
+def generate(database_path, items=100000, movie_libraries=2, show_libraries=2, episodes_per_show=20,
+             missing_poster_ratio=0.05, unanalyzed_ratio=0.02, duplicate_ratio=0.01, collections=50,
+             collection_size=10, seed=1):
+    """
+    Generate a Plex-like database of roughly items metadata items spread over movie and show libraries.
+
+    Movies and episodes get one media item with one part each. The given ratios of items have a missing poster,
+    unanalyzed media (bitrate is null) or a part duplicating the size and hash of another part.
+    Returns a dict of the row counts per table.
+    """
+    rnd = random.Random(seed)
+    if os.path.exists(database_path):
+        os.remove(database_path)
+
+    conn = sqlite3.connect(database_path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(SCHEMA)
+    now = int(time.time())
+
+    # libraries, section_type 1 is movies and 2 is shows
+    sections = [(section_id, f"Movies {section_id}", 1) for section_id in range(1, movie_libraries + 1)]
+    sections += [(section_id, f"TV {section_id}", 2)
+                 for section_id in range(movie_libraries + 1, movie_libraries + show_libraries + 1)]
+    insert_rows(conn, 'library_sections', ['id', 'name', 'section_type', 'created_at'],
+                ((section_id, name, section_type, now) for section_id, name, section_type in sections))
+
+    # split items between movies and episodes, each show owning episodes_per_show episodes
+    movie_sections = [section for section in sections if section[2] == 1]
+    show_sections = [section for section in sections if section[2] == 2]
+    movie_count = items if not show_sections else (items // 2 if movie_sections else 0)
+    show_count = (items - movie_count) // (episodes_per_show + 1) if show_sections else 0
+
+    counts = {'library_sections': len(sections), 'metadata_items': 0, 'media_items': 0, 'media_parts': 0,
+              'tags': 0, 'taggings': 0}
+    duplicates = []
+
+    def poster_url(metadata_type, metadata_item_id):
+        if rnd.random() < missing_poster_ratio:
+            return '' if metadata_type != 1 or rnd.random() < 0.5 else f"media://{metadata_item_id}/thumb.jpg"
+        return f"metadata://posters/com.plexapp.agents.themoviedb_{metadata_item_id}"
+
+    def part_row(part_id, media_item_id, file_path):
+        # duplicate an earlier part for a share of the parts
+        if duplicates and rnd.random() < duplicate_ratio:
+            size, part_hash = rnd.choice(duplicates)
+        else:
+            size, part_hash = rnd.randint(200 * 1024 ** 2, 40 * 1024 ** 3), f"{rnd.getrandbits(160):040x}"
+            if len(duplicates) < 10000:
+                duplicates.append((size, part_hash))
+        return part_id, media_item_id, part_hash, file_path, size, now
+
+    def media_rows():
+        metadata_item_id = 0
+        for movie_index in range(movie_count):
+            section_id = movie_sections[movie_index % len(movie_sections)][0]
+            metadata_item_id += 1
+            guid = (f"com.plexapp.agents.imdb://tt{metadata_item_id:07d}?lang=en" if movie_index % 3
+                    else f"com.plexapp.agents.themoviedb://{metadata_item_id}?lang=en")
+            yield ('metadata', (metadata_item_id, section_id, None, 1, guid, f"Movie {metadata_item_id}",
+                                rnd.randint(1920, 2020), poster_url(1, metadata_item_id),
+                                now - rnd.randint(0, 10 * 365 * 86400)))
+            yield ('media', section_id, metadata_item_id, f"/data/Movies/Movie {metadata_item_id}/movie.mkv")
+
+        for show_index in range(show_count):
+            section_id = show_sections[show_index % len(show_sections)][0]
+            metadata_item_id += 1
+            show_id = metadata_item_id
+            yield ('metadata', (show_id, section_id, None, 2, f"com.plexapp.agents.thetvdb://{show_id}?lang=en",
+                                f"Show {show_id}", rnd.randint(1950, 2020), poster_url(2, show_id),
+                                now - rnd.randint(0, 10 * 365 * 86400)))
+            for episode_index in range(1, episodes_per_show + 1):
+                metadata_item_id += 1
+                yield ('metadata', (metadata_item_id, section_id, show_id, 4,
+                                    f"com.plexapp.agents.thetvdb://{show_id}/1/{episode_index}?lang=en",
+                                    f"Episode {episode_index}", None, '', now - rnd.randint(0, 10 * 365 * 86400)))
+                yield ('media', section_id, metadata_item_id,
+                       f"/data/TV/Show {show_id}/Season 01/S01E{episode_index:02d}.mkv")
+
+    metadata_rows, media_item_rows, media_part_rows = [], [], []
+    metadata_columns = ['id', 'library_section_id', 'parent_id', 'metadata_type', 'guid', 'title', 'year',
+                        'user_thumb_url', 'added_at']
+    media_item_columns = ['id', 'library_section_id', 'metadata_item_id', 'size', 'bitrate', 'created_at']
+    media_part_columns = ['id', 'media_item_id', 'hash', 'file', 'size', 'created_at']
+
+    def flush():
+        insert_rows(conn, 'metadata_items', metadata_columns, metadata_rows)
+        insert_rows(conn, 'media_items', media_item_columns, media_item_rows)
+        insert_rows(conn, 'media_parts', media_part_columns, media_part_rows)
+        counts['metadata_items'] += len(metadata_rows)
+        counts['media_items'] += len(media_item_rows)
+        counts['media_parts'] += len(media_part_rows)
+        del metadata_rows[:], media_item_rows[:], media_part_rows[:]
+
+    for row in media_rows():
+        if row[0] == 'metadata':
+            metadata_rows.append(row[1])
+        else:
+            _, section_id, metadata_item_id, file_path = row
+            media_item_id = len(media_item_rows) + counts['media_items'] + 1
+            part = part_row(media_item_id, media_item_id, file_path)
+            bitrate = None if rnd.random() < unanalyzed_ratio else rnd.randint(1000000, 40000000)
+            media_item_rows.append((media_item_id, section_id, metadata_item_id, part[4], bitrate, now))
+            media_part_rows.append(part)
+
+        if len(metadata_rows) >= INSERT_BATCH_SIZE:
+            flush()
+    flush()
+
+    # collections of movies, tag_type 2 is a collection tag and metadata_type 18 a collection item
+    collection_id = counts['metadata_items']
+    for tag_id in range(1, (collections if movie_count else 0) + 1):
+        section_id = movie_sections[tag_id % len(movie_sections)][0]
+        collection_id += 1
+        conn.execute("INSERT INTO metadata_items (id, library_section_id, metadata_type, guid, title, "
+                     "user_thumb_url, added_at) VALUES (?, ?, 18, ?, ?, '', ?)",
+                     [collection_id, section_id, f"collection://{tag_id}", f"Collection {tag_id}", now])
+        conn.execute("INSERT INTO tags (id, tag, tag_type, created_at) VALUES (?, ?, 2, ?)",
+                     [tag_id, f"Collection {tag_id}", now])
+        members = conn.execute("SELECT id FROM metadata_items WHERE library_section_id = ? AND metadata_type = 1 "
+                               "ORDER BY random() LIMIT ?", [section_id, collection_size]).fetchall()
+        insert_rows(conn, 'taggings', ['metadata_item_id', 'tag_id', 'created_at'],
+                    ((member[0], tag_id, now) for member in members))
+        counts['metadata_items'] += 1
+        counts['tags'] += 1
+        counts['taggings'] += len(members)
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    # Plex runs its database in wal mode
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Plex database')
+    parser.add_argument('--output', required=True, help='Path of the database to create, replaced if it exists')
+    parser.add_argument('--items', type=int, default=100000, help='Approximate number of metadata items')
+    parser.add_argument('--movie-libraries', type=int, default=2)
+    parser.add_argument('--show-libraries', type=int, default=2)
+    parser.add_argument('--episodes-per-show', type=int, default=20)
+    parser.add_argument('--missing-poster-ratio', type=float, default=0.05)
+    parser.add_argument('--unanalyzed-ratio', type=float, default=0.02)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--collections', type=int, default=50)
+    parser.add_argument('--collection-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    counts = generate(args.output, items=args.items, movie_libraries=args.movie_libraries,
+                      show_libraries=args.show_libraries, episodes_per_show=args.episodes_per_show,
+                      missing_poster_ratio=args.missing_poster_ratio, unanalyzed_ratio=args.unanalyzed_ratio,
+                      duplicate_ratio=args.duplicate_ratio, collections=args.collections,
+                      collection_size=args.collection_size, seed=args.seed)
+    print(json.dumps({'database': args.output, 'seconds': round(time.monotonic() - started, 2), 'counts': counts},
+                     indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1 @@
-from . import library, metadata, actions
\ No newline at end of file
+from . import library, metadata, actions, client, report
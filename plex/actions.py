@@ -1,20 +1,20 @@
-import requests
+from collections import OrderedDict
+
 from loguru import logger
 
 from utils import misc
 from . import metadata
+from .client import get_client
 
 
 def refresh_item_metadata(cfg, metadata_item_id):
     try:
-        plex_refresh_url = misc.urljoin(cfg.plex.url, f'/library/metadata/{metadata_item_id}/refresh')
-        params = {
-            'X-Plex-Token': cfg.plex.token
-        }
+        client = get_client(cfg)
+        plex_refresh_path = f'/library/metadata/{metadata_item_id}/refresh'
 
         # send refresh request
-        logger.debug(f"Sending refresh metadata request to: {plex_refresh_url}")
-        resp = requests.put(plex_refresh_url, params=params, verify=False, timeout=30)
+        logger.debug(f"Sending refresh metadata request to: {client.build_url(plex_refresh_path)}")
+        resp = client.put(plex_refresh_path, timeout=30)
 
         logger.trace(f"Request URL: {resp.url}")
         logger.trace(f"Response: {resp.status_code} {resp.reason}")
@@ -30,16 +30,58 @@ def refresh_item_metadata(cfg, metadata_item_id):
     return False
 
 
-def analyze_metadata_item(cfg, metadata_item_id):
+def refresh_section_metadata(cfg, library_section_id):
     try:
-        plex_analyze_url = misc.urljoin(cfg.plex.url, f'/library/metadata/{metadata_item_id}/analyze')
-        params = {
-            'X-Plex-Token': cfg.plex.token
+        client = get_client(cfg)
+        plex_refresh_path = f'/library/sections/{library_section_id}/refresh'
+
+        # send a forced refresh request for every item of the section
+        logger.debug(f"Sending refresh section metadata request to: {client.build_url(plex_refresh_path)}")
+        resp = client.get(plex_refresh_path, params={'force': 1}, timeout=30)
+
+        logger.trace(f"Request URL: {resp.url}")
+        logger.trace(f"Response: {resp.status_code} {resp.reason}")
+
+        if resp.status_code != 200:
+            logger.error(f"Failed refreshing metadata for section {library_section_id!r}: "
+                         f"{resp.status_code} {resp.reason}")
+            return False
+
+        return True
+    except Exception:
+        logger.exception(f"Exception refreshing Plex metadata for section {library_section_id}: ")
+    return False
+
+
+def get_server_load(cfg):
+    """Return the number of playing sessions, transcodes and running activities of the Plex Media Server"""
+    try:
+        client = get_client(cfg)
+
+        # retrieve sessions and activities
+        sessions = client.get_json('/status/sessions', timeout=10).get('Metadata', [])
+        activities = client.get_json('/activities', timeout=10).get('Activity', [])
+
+        load = {
+            'sessions': len(sessions),
+            'transcodes': sum(1 for session in sessions if 'TranscodeSession' in session),
+            'activities': len(activities),
         }
+        logger.trace(f"Server load: {load}")
+        return load
+    except Exception:
+        logger.exception("Exception retrieving the Plex Media Server load: ")
+    return None
+
+
+def analyze_metadata_item(cfg, metadata_item_id):
+    try:
+        client = get_client(cfg)
+        plex_analyze_path = f'/library/metadata/{metadata_item_id}/analyze'
 
         # send refresh request
-        logger.debug(f"Sending analyze metadata_item_id request to: {plex_analyze_url}")
-        resp = requests.put(plex_analyze_url, params=params, verify=False, timeout=600)
+        logger.debug(f"Sending analyze metadata_item_id request to: {client.build_url(plex_analyze_path)}")
+        resp = client.put(plex_analyze_path, timeout=600)
 
         logger.trace(f"Request URL: {resp.url}")
         logger.trace(f"Response: {resp.status_code} {resp.reason}")
@@ -54,43 +96,68 @@ def analyze_metadata_item(cfg, metadata_item_id):
     return False
 
 
-def set_metadata_item_collection(cfg, metadata_item_id, collection_name):
+def update_section_items(cfg, library_section_id, metadata_type, metadata_item_ids, update_params):
     try:
-        # retrieve metadata_item_id details
-        result = metadata.get_metadata_item_id(cfg.plex.database_path, metadata_item_id)
-        if not result or not misc.dict_contains_keys(result, ['id', 'library_section_id', 'metadata_type']):
-            logger.error(f"Unable to find metadata_item with id: {metadata_item_id!r}")
-            return False
-
-        # we have the details we need to build a metadata_item update
-        plex_update_url = misc.urljoin(cfg.plex.url, f"/library/sections/{result['library_section_id']}/all")
+        client = get_client(cfg)
+        plex_update_path = f"/library/sections/{library_section_id}/all"
         params = {
-            'X-Plex-Token': cfg.plex.token,
-            'id': metadata_item_id,
-            'type': result['metadata_type'],
-            'collection[0].tag.tag': collection_name,
+            'id': ','.join(str(metadata_item_id) for metadata_item_id in metadata_item_ids),
+            'type': metadata_type,
             'includeExternalMedia': 1
         }
+        params.update(update_params)
 
         # send update request
-        logger.debug(f"Sending update metadata_item_id request to: {plex_update_url}")
-        resp = requests.put(plex_update_url, params=params, verify=False, timeout=600)
+        logger.debug(f"Sending update request for {len(metadata_item_ids)} metadata_items to: "
+                     f"{client.build_url(plex_update_path)}")
+        resp = client.put(plex_update_path, params=params, timeout=600)
 
         logger.trace(f"Request URL: {resp.url}")
         logger.trace(f"Response: {resp.status_code} {resp.reason}")
 
         if resp.status_code != 200:
-            logger.error(f"Failed updating metadata_item {metadata_item_id!r}: {resp.status_code} {resp.reason}")
+            logger.error(f"Failed updating metadata_items {metadata_item_ids!r}: {resp.status_code} {resp.reason}")
             return False
 
         return True
 
     except Exception:
-        logger.exception(f"Exception updating metadata_item with id {metadata_item_id!r} to be in the "
-                         f"{collection_name!r} collection: ")
+        logger.exception(f"Exception updating metadata_items {metadata_item_ids!r} of section {library_section_id!r}: ")
     return False
 
 
+def set_metadata_items_collection(cfg, metadata_items, collection_name, chunk_size=50):
+    """
+    Add metadata_items to a collection, tagging up to chunk_size items of the same section and type per request.
+
+    metadata_items must have id, library_section_id and metadata_type attributes. Items of a failed batch are
+    retried one at a time. Returns the ids of the items that were added to the collection.
+    """
+    update_params = {'collection[0].tag.tag': collection_name}
+
+    # group items by section and type
+    groups = OrderedDict()
+    for metadata_item in metadata_items:
+        groups.setdefault((metadata_item.library_section_id, metadata_item.metadata_type), []).append(metadata_item.id)
+
+    added_item_ids = []
+    for (library_section_id, metadata_type), metadata_item_ids in groups.items():
+        for chunk_start in range(0, len(metadata_item_ids), chunk_size):
+            chunk = metadata_item_ids[chunk_start:chunk_start + chunk_size]
+            if update_section_items(cfg, library_section_id, metadata_type, chunk, update_params):
+                added_item_ids.extend(chunk)
+                continue
+
+            # fallback to updating items individually
+            logger.warning(f"Failed adding a batch of {len(chunk)} metadata_items to collection {collection_name!r}, "
+                           f"retrying them individually")
+            for metadata_item_id in chunk:
+                if update_section_items(cfg, library_section_id, metadata_type, [metadata_item_id], update_params):
+                    added_item_ids.append(metadata_item_id)
+
+    return added_item_ids
+
+
 def set_metadata_item_summary(cfg, metadata_item_id, summary):
     try:
         # retrieve metadata_item_id details
@@ -99,28 +166,8 @@ def set_metadata_item_summary(cfg, metadata_item_id, summary):
             logger.error(f"Unable to find metadata_item with id: {metadata_item_id!r}")
             return False
 
-        # we have the details we need to build a metadata_item update
-        plex_update_url = misc.urljoin(cfg.plex.url, f"/library/sections/{result['library_section_id']}/all")
-        params = {
-            'X-Plex-Token': cfg.plex.token,
-            'id': metadata_item_id,
-            'type': result['metadata_type'],
-            'summary.value': summary,
-            'includeExternalMedia': 1
-        }
-
-        # send update request
-        logger.debug(f"Sending update metadata_item_id request to: {plex_update_url}")
-        resp = requests.put(plex_update_url, params=params, verify=False, timeout=600)
-
-        logger.trace(f"Request URL: {resp.url}")
-        logger.trace(f"Response: {resp.status_code} {resp.reason}")
-
-        if resp.status_code != 200:
-            logger.error(f"Failed updating metadata_item {metadata_item_id!r}: {resp.status_code} {resp.reason}")
-            return False
-
-        return True
+        return update_section_items(cfg, result['library_section_id'], result['metadata_type'], [metadata_item_id],
+                                    {'summary.value': summary})
 
     except Exception:
         logger.exception(f"Exception updating the summary of metadata_item with id {metadata_item_id!r}")
@@ -129,16 +176,16 @@ def set_metadata_item_summary(cfg, metadata_item_id, summary):
 
 def set_metadata_item_poster(cfg, metadata_item_id, poster_url):
     try:
-        plex_update_url = misc.urljoin(cfg.plex.url, f"/library/metadata/{metadata_item_id}/posters")
+        client = get_client(cfg)
+        plex_update_path = f"/library/metadata/{metadata_item_id}/posters"
         params = {
-            'X-Plex-Token': cfg.plex.token,
             'includeExternalMedia': 1,
             'url': poster_url
         }
 
         # send update request
-        logger.debug(f"Sending update metadata_item_id request to {plex_update_url}")
-        resp = requests.post(plex_update_url, params=params, verify=False, timeout=600)
+        logger.debug(f"Sending update metadata_item_id request to {client.build_url(plex_update_path)}")
+        resp = client.post(plex_update_path, params=params, timeout=600)
 
         logger.trace(f"Request URL: {resp.url}")
         logger.trace(f"Response: {resp.status_code} {resp.reason}")
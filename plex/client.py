@@ -0,0 +1,59 @@
+import re
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import misc, metrics
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+
+
+class PlexClient(object, metaclass=misc.Singleton):
+    """
+    Shared Plex client keeping a pool of keep-alive connections to the Plex Media Server
+    """
+
+    def __init__(self, url, token, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+        # build pooled session
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'X-Plex-Token': token})
+        self.session.verify = False
+
+    def build_url(self, path):
+        return misc.urljoin(self.url, path)
+
+    def request(self, method, path, params=None, timeout=None, headers=None):
+        # label metrics by endpoint rather than by item
+        operation = f"{method} {re.sub(r'/[0-9]+', '/{id}', path)}"
+        with metrics.timer('plex', operation) as timing:
+            resp = self.session.request(method, self.build_url(path), params=params, headers=headers,
+                                        timeout=timeout if timeout is not None else self.timeout)
+            timing['error'] = resp.status_code >= 400
+            timing['bytes'] = len(resp.content)
+            return resp
+
+    def get(self, path, params=None, timeout=None, headers=None):
+        return self.request('GET', path, params=params, timeout=timeout, headers=headers)
+
+    def get_json(self, path, params=None, timeout=None):
+        """Request path as json, returns the decoded MediaContainer, raises on a failed request"""
+        resp = self.get(path, params=params, timeout=timeout, headers={'Accept': 'application/json'})
+        resp.raise_for_status()
+        return resp.json().get('MediaContainer', {})
+
+    def put(self, path, params=None, timeout=None):
+        return self.request('PUT', path, params=params, timeout=timeout)
+
+    def post(self, path, params=None, timeout=None):
+        return self.request('POST', path, params=params, timeout=timeout)
+
+
+def get_client(cfg):
+    return PlexClient(cfg.plex.url, cfg.plex.token, pool_size=cfg.plex.pool_size or DEFAULT_POOL_SIZE)
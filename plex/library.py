@@ -23,3 +23,24 @@ def find_library_type(database_path, library_name):
     # we have an unexpected result?
     logger.debug(f"Failed to find library with name: {library_name!r}, unexpected query result:\n{result}")
     return None
+
+
+def find_libraries(database_path, library_names=None):
+    """Return the id, name and section_type of the named libraries, or of every library when no names are given"""
+    query_str = """SELECT
+                    ls.id, ls.name, ls.section_type
+                    FROM library_sections ls"""
+    query_args = []
+    if library_names:
+        query_str += f"\n                    WHERE ls.name IN ({', '.join('?' * len(library_names))})"
+        query_args = list(library_names)
+    query_str += "\n                    ORDER BY ls.name"
+
+    # lookup libraries
+    results = sql.get_query_results(database_path, query_str, query_args)
+    if results is None:
+        logger.debug(f"Failed to find libraries: {library_names!r}")
+        return None
+
+    logger.debug(f"Found {len(results)} libraries: {', '.join(repr(result['name']) for result in results)}")
+    return results
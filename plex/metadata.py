@@ -1,33 +1,230 @@
+import itertools
+from collections import namedtuple
+
 from loguru import logger
 
 from utils import sql
 from . import library
 
+# sqlite's default SQLITE_MAX_VARIABLE_NUMBER is 999, leave room for the other query arguments
+QUERY_CHUNK_SIZE = 900
+
+# query result records, fields must match the order of the selected columns
+UnanalyzedItem = namedtuple('UnanalyzedItem', ['metadata_item_id', 'media_item_id', 'library_name', 'file', 'size'],
+                            defaults=[None])
+MissingPosterItem = namedtuple('MissingPosterItem', ['id', 'library_name', 'title', 'year', 'guid', 'user_thumb_url',
+                                                     'added_at'])
+CollectionCandidate = namedtuple('CollectionCandidate', ['id', 'library_section_id', 'metadata_type', 'guid', 'title',
+                                                         'year'])
+DuplicatePart = namedtuple('DuplicatePart', ['match', 'key', 'library_name', 'metadata_item_id', 'title',
+                                             'media_item_id', 'part_id', 'file', 'size', 'bitrate'])
+
+# column types of the records, fields not listed are strings
+UNANALYZED_ITEM_TYPES = {'metadata_item_id': int, 'media_item_id': int, 'size': int}
+MISSING_POSTER_ITEM_TYPES = {'id': int, 'year': int, 'added_at': int}
+DUPLICATE_PART_TYPES = {'metadata_item_id': int, 'media_item_id': int, 'part_id': int, 'size': int, 'bitrate': int}
+
 METADATA_MISSING_QUERY_STRINGS = {
     '1': """SELECT
-            ls.name as library_name
-            , md.*
+            md.id
+            , ls.name as library_name
+            , md.title
+            , md.year
+            , md.guid
+            , md.user_thumb_url
+            , COALESCE(md.added_at, 0) as added_at
             FROM metadata_items md
             JOIN library_sections ls ON ls.id = md.library_section_id
             WHERE 
-            ls.name = ?
+            {sections}
             AND md.metadata_type = 1
             AND (md.user_thumb_url like 'media://%' OR md.user_thumb_url = '')
-            ORDER BY md.added_at ASC""",
+            {filters}
+            ORDER BY md.library_section_id ASC, COALESCE(md.added_at, 0) ASC, md.id ASC""",
     '2': """SELECT
-            ls.name as library_name
-            , md.*
+            md.id
+            , ls.name as library_name
+            , md.title
+            , md.year
+            , md.guid
+            , md.user_thumb_url
+            , COALESCE(md.added_at, 0) as added_at
             FROM metadata_items md
             JOIN library_sections ls ON ls.id = md.library_section_id
             WHERE 
-            ls.name = ?
+            {sections}
             AND md.metadata_type = 2
             AND md.user_thumb_url = ''
-            ORDER BY md.added_at ASC"""
+            {filters}
+            ORDER BY md.library_section_id ASC, COALESCE(md.added_at, 0) ASC, md.id ASC"""
 }
 
+UNANALYZED_QUERY_STRING = """select
+                    mi.metadata_item_id
+                    , mi.id as media_item_id
+                    , ls.name as library_name
+                    , mp.file
+                    , mp.size
+                    from media_items mi
+                    join media_parts mp on mp.media_item_id = mi.id
+                    join library_sections ls on ls.id = mi.library_section_id
+                    where mi.bitrate is null and ls.section_type in (1, 2) and {sections}
+                    {filters}
+                    order by mi.library_section_id, mi.id"""
+
+DUPLICATE_FILES_QUERY_STRING = """WITH parts AS (
+                    SELECT
+                    mp.id as part_id
+                    , mp.size
+                    , {hash} as hash
+                    , mp.file
+                    , mi.id as media_item_id
+                    , mi.bitrate
+                    , md.id as metadata_item_id
+                    , md.title
+                    , ls.name as library_name
+                    FROM media_parts mp
+                    JOIN media_items mi ON mi.id = mp.media_item_id
+                    JOIN metadata_items md ON md.id = mi.metadata_item_id
+                    JOIN library_sections ls ON ls.id = mi.library_section_id
+                    WHERE {sections}
+                    AND mp.size > 0
+                    ), duplicate_keys AS (
+                    SELECT size, hash
+                    FROM parts
+                    GROUP BY size, hash
+                    HAVING COUNT(DISTINCT file) > 1
+                    )
+                    SELECT
+                    'files' as match
+                    , {key} as key
+                    , parts.library_name
+                    , parts.metadata_item_id
+                    , parts.title
+                    , parts.media_item_id
+                    , parts.part_id
+                    , parts.file
+                    , parts.size
+                    , parts.bitrate
+                    FROM parts
+                    JOIN duplicate_keys ON duplicate_keys.size = parts.size AND duplicate_keys.hash = parts.hash
+                    ORDER BY parts.size DESC, parts.hash, parts.part_id"""
+
+DUPLICATE_GUIDS_QUERY_STRING = """WITH parts AS (
+                    SELECT
+                    md.guid
+                    , md.id as metadata_item_id
+                    , md.title
+                    , mi.id as media_item_id
+                    , mi.bitrate
+                    , mp.id as part_id
+                    , mp.file
+                    , mp.size
+                    , ls.name as library_name
+                    FROM metadata_items md
+                    JOIN media_items mi ON mi.metadata_item_id = md.id
+                    JOIN media_parts mp ON mp.media_item_id = mi.id
+                    JOIN library_sections ls ON ls.id = md.library_section_id
+                    WHERE {sections}
+                    AND md.guid != ''
+                    ), duplicate_keys AS (
+                    SELECT guid
+                    FROM parts
+                    GROUP BY guid
+                    HAVING COUNT(DISTINCT media_item_id) > 1 AND COUNT(DISTINCT file) > 1
+                    )
+                    SELECT
+                    'guid' as match
+                    , parts.guid as key
+                    , parts.library_name
+                    , parts.metadata_item_id
+                    , parts.title
+                    , parts.media_item_id
+                    , parts.part_id
+                    , parts.file
+                    , parts.size
+                    , parts.bitrate
+                    FROM parts
+                    JOIN duplicate_keys ON duplicate_keys.guid = parts.guid
+                    ORDER BY parts.guid, parts.metadata_item_id, parts.media_item_id, parts.part_id"""
+
+
+def missing_poster_mark(item):
+    """Return the (added_at, id) mark of a MissingPosterItem, the order of the missing poster queries"""
+    return [item.added_at, item.id]
+
+
+def unanalyzed_mark(item):
+    """Return the (media item id,) mark of an UnanalyzedItem, the order of the unanalyzed query"""
+    return [item.media_item_id]
+
+
+def iter_filtered_results(database_path, query_str, query_args, record, id_column, mark_columns, record_id,
+                          after=None, item_ids=None, sections='ls.name = ?'):
+    """
+    Stream the results of a query with {sections} and {filters} placeholders, optionally restricted to the rows
+    after the high-water mark after, compared against mark_columns, or to the rows whose id_column is in item_ids.
+
+    The ids of the matching rows are read up front with a single statement, the rows are then read in chunks of ids,
+    so no statement holds a read transaction open while the rows are acted on. record_id returns the id_column value
+    of a record, the query must be ordered by mark_columns.
+    sections is the condition selecting the library sections, its arguments lead query_args.
+    Returns None when the query could not be run, a failure on a later chunk raises sql.QueryError.
+    """
+    query_name = sql.caller_name()
+
+    def run_query(filters, filter_args):
+        return sql.get_query_results(database_path, query_str.format(sections=sections, filters=filters),
+                                     query_args + filter_args, record=record, query_name=query_name)
+
+    if item_ids is None:
+        filters, filter_args = '', []
+        if after is not None:
+            filters = f"AND ({', '.join(mark_columns)}) > ({', '.join('?' * len(mark_columns))})"
+            filter_args = list(after)
+
+        # the ids are consumed as they stream, rows sharing an id follow each other
+        results = sql.iter_query_results(database_path, query_str.format(sections=sections, filters=filters),
+                                         query_args + filter_args, record=record, query_name=query_name)
+        if results is None:
+            return None
+        item_ids = []
+        try:
+            for result in results:
+                if not item_ids or item_ids[-1] != record_id(result):
+                    item_ids.append(record_id(result))
+        except sql.QueryError:
+            return None
 
-def find_items_missing_posters(database_path, library_name):
+    # query item_ids in chunks, the first chunk is run up front to catch a failing query
+    item_ids = list(item_ids)
+    chunks = [item_ids[chunk_start:chunk_start + QUERY_CHUNK_SIZE]
+              for chunk_start in range(0, len(item_ids), QUERY_CHUNK_SIZE)] or [[]]
+
+    def run_chunk(chunk):
+        return run_query(f"AND {id_column} IN ({', '.join('?' * len(chunk))})", chunk)
+
+    first_results = run_chunk(chunks[0])
+    if first_results is None:
+        return None
+
+    def iter_chunks():
+        yield from first_results
+        for chunk in chunks[1:]:
+            results = run_chunk(chunk)
+            if results is None:
+                raise sql.QueryError(f"Failed reading the results of query {query_name!r}")
+            yield from results
+
+    return iter_chunks()
+
+
+def find_items_missing_posters(database_path, library_name, after=None, item_ids=None):
+    """
+    Stream the items of library_name with a missing poster, ordered by added_at and id.
+
+    after restricts the scan to items after an (added_at, id) high-water mark, item_ids to the given items.
+    """
     logger.debug(f"Finding items with missing posters from library: {library_name!r}")
 
     # determine library type
@@ -43,24 +240,161 @@ def find_items_missing_posters(database_path, library_name):
 
     # find items
     query_str = METADATA_MISSING_QUERY_STRINGS[str(library_type)]
-    return sql.get_query_results(database_path, query_str, [library_name])
+    return iter_filtered_results(database_path, query_str, [library_name], MissingPosterItem, 'md.id',
+                                 ['COALESCE(md.added_at, 0)', 'md.id'], lambda item: item.id, after=after,
+                                 item_ids=item_ids)
+
 
+def find_items_unanalyzed(database_path, library_name, after=None, item_ids=None):
+    """
+    Stream the media items of library_name without analysis, ordered by media item id.
 
-def find_items_unanalyzed(database_path, library_name):
+    after restricts the scan to media items after a (media item id,) high-water mark, item_ids to the given
+    media items.
+    """
     logger.debug(f"Finding items without analysis from library: {library_name!r}")
 
-    # build query_str
-    query_str = """select
+    # retrieve results
+    return iter_filtered_results(database_path, UNANALYZED_QUERY_STRING, [library_name], UnanalyzedItem, 'mi.id',
+                                 ['mi.id'], lambda item: item.media_item_id, after=after, item_ids=item_ids)
+
+
+def sections_condition(libraries):
+    """Return the condition and arguments selecting the library sections of libraries"""
+    return f"ls.id IN ({', '.join('?' * len(libraries))})", [section['id'] for section in libraries]
+
+
+def find_libraries_items_missing_posters(database_path, libraries):
+    """
+    Stream the items with a missing poster of every library in libraries, as returned by
+    plex.library.find_libraries, with one query per library type.
+
+    Items are grouped by library, libraries of a type without a query are skipped.
+    """
+    logger.debug(f"Finding items with missing posters from {len(libraries)} libraries")
+
+    # group libraries by type
+    libraries_by_type = {}
+    for section in libraries:
+        if str(section['section_type']) not in METADATA_MISSING_QUERY_STRINGS:
+            logger.warning(f"Unable to find items with missing posters for library {section['name']!r} of type: "
+                           f"{section['section_type']!r}")
+            continue
+        libraries_by_type.setdefault(str(section['section_type']), []).append(section)
+
+    # run the query of every type up front to catch a failing query
+    type_results = []
+    for library_type, type_libraries in libraries_by_type.items():
+        sections, section_ids = sections_condition(type_libraries)
+        results = iter_filtered_results(
+            database_path, METADATA_MISSING_QUERY_STRINGS[library_type], section_ids, MissingPosterItem, 'md.id',
+            ['md.library_section_id', 'COALESCE(md.added_at, 0)', 'md.id'], lambda item: item.id, sections=sections)
+        if results is None:
+            return None
+        type_results.append(results)
+
+    return itertools.chain.from_iterable(type_results)
+
+
+def count_libraries_items_missing_posters(database_path, libraries):
+    """Return a dict of library name to the number of its items with a missing poster, or None on failure"""
+    counts = {}
+    for library_type in {str(section['section_type']) for section in libraries}:
+        if library_type not in METADATA_MISSING_QUERY_STRINGS:
+            continue
+
+        sections, section_ids = sections_condition([section for section in libraries
+                                                    if str(section['section_type']) == library_type])
+        query_str = f"""SELECT library_name, COUNT(*) as items
+                    FROM ({METADATA_MISSING_QUERY_STRINGS[library_type].format(sections=sections, filters='')})
+                    GROUP BY library_name"""
+        results = sql.get_query_results(database_path, query_str, section_ids)
+        if results is None:
+            return None
+        counts.update((result['library_name'], result['items']) for result in results)
+    return counts
+
+
+def count_libraries_items(database_path, libraries):
+    """Return a dict of library name to the number of its movies or shows, or None on failure"""
+    sections, section_ids = sections_condition(libraries)
+    query_str = f"""SELECT
                     ls.name as library_name
-                    , mp.file
-                    , mi.*
-                    from media_items mi
-                    join media_parts mp on mp.media_item_id = mi.id
-                    join library_sections ls on ls.id = mi.library_section_id
-                    where mi.bitrate is null and ls.section_type in (1, 2) and ls.name = ?"""
+                    , COUNT(*) as items
+                    FROM metadata_items md
+                    JOIN library_sections ls ON ls.id = md.library_section_id
+                    WHERE {sections}
+                    AND md.metadata_type = ls.section_type
+                    GROUP BY ls.name"""
+    results = sql.get_query_results(database_path, query_str, section_ids)
+    if results is None:
+        return None
+    return {result['library_name']: result['items'] for result in results}
+
+
+def find_libraries_items_unanalyzed(database_path, libraries):
+    """
+    Stream the media items without analysis of every library in libraries, as returned by
+    plex.library.find_libraries, with a single query.
+
+    Items are grouped by library.
+    """
+    logger.debug(f"Finding items without analysis from {len(libraries)} libraries")
+
+    sections, section_ids = sections_condition(libraries)
+    return iter_filtered_results(database_path, UNANALYZED_QUERY_STRING, section_ids, UnanalyzedItem, 'mi.id',
+                                 ['mi.library_section_id', 'mi.id'], lambda item: item.media_item_id,
+                                 sections=sections)
+
+
+def count_libraries_items_unanalyzed(database_path, libraries):
+    """Return the number of media parts without analysis of every library in libraries, or None on failure"""
+    sections, section_ids = sections_condition(libraries)
+    query_str = f"""SELECT COUNT(*) as items
+                    FROM ({UNANALYZED_QUERY_STRING.format(sections=sections, filters='')})"""
+    result = sql.get_query_result(database_path, query_str, section_ids)
+    if result is None:
+        return None
+    return result['items']
+
+
+def find_libraries_duplicate_files(database_path, libraries, match_hash=True):
+    """
+    Stream the media parts of every library in libraries, as returned by plex.library.find_libraries, sharing their
+    size with another file, and their hash when match_hash. Parts without a hash only match on size, parts of the same
+    file, a folder added to several libraries, are not duplicates of each other.
+
+    Parts are grouped by their key, largest files first, see iter_duplicate_groups.
+    """
+    logger.debug(f"Finding duplicate files from {len(libraries)} libraries")
+
+    sections, section_ids = sections_condition(libraries)
+    if match_hash:
+        hash_column, key = "COALESCE(mp.hash, '')", "parts.size || ':' || parts.hash"
+    else:
+        hash_column, key = "''", "CAST(parts.size AS TEXT)"
+    query_str = DUPLICATE_FILES_QUERY_STRING.format(sections=sections, hash=hash_column, key=key)
+    return sql.iter_query_results(database_path, query_str, section_ids, record=DuplicatePart)
+
+
+def find_libraries_duplicate_guids(database_path, libraries):
+    """
+    Stream the media parts of every library in libraries, as returned by plex.library.find_libraries, whose item
+    shares its guid with other media items of other files, either another item or another version of the same item.
+
+    Parts are grouped by guid, see iter_duplicate_groups.
+    """
+    logger.debug(f"Finding duplicate guids from {len(libraries)} libraries")
+
+    sections, section_ids = sections_condition(libraries)
+    return sql.iter_query_results(database_path, DUPLICATE_GUIDS_QUERY_STRING.format(sections=sections), section_ids,
+                                  record=DuplicatePart)
 
-    # retrieve results
-    return sql.get_query_results(database_path, query_str, [library_name])
+
+def iter_duplicate_groups(parts):
+    """Group the consecutive parts streamed by the find_libraries_duplicate_* functions, yielding lists of parts"""
+    for _, group in itertools.groupby(parts, key=lambda part: (part.match, part.key)):
+        yield list(group)
 
 
 def get_metadata_item_id(database_path, metadata_item_id):
@@ -72,6 +406,7 @@ def get_metadata_item_id(database_path, metadata_item_id):
                     , mi.library_section_id
                     , mi.metadata_type
                     , mi.guid
+                    , mi.user_thumb_url
                     FROM metadata_items mi
                     WHERE mi.id = ?"""
 
@@ -100,6 +435,73 @@ def get_metadata_item_by_guid(database_path, library_name, guid):
     return sql.get_query_result(database_path, query_str, [library_name, guid])
 
 
+def get_metadata_items_by_guids(database_path, library_name, guids):
+    logger.debug(f"Finding metadata_item details from library {library_name!r} for {len(guids)} guids")
+
+    results = []
+    guids = list(dict.fromkeys(guids))
+    for chunk_start in range(0, len(guids), QUERY_CHUNK_SIZE):
+        chunk = guids[chunk_start:chunk_start + QUERY_CHUNK_SIZE]
+
+        # build query_str
+        query_str = f"""SELECT
+                        mi.id
+                        , mi.library_section_id
+                        , mi.metadata_type
+                        , mi.guid
+                        , mi.title
+                        , mi.year
+                        FROM metadata_items mi
+                        JOIN library_sections ls ON ls.id = mi.library_section_id
+                        WHERE
+                        ls.name = ?
+                        AND
+                        mi.guid IN ({', '.join('?' * len(chunk))})"""
+
+        # retrieve results
+        chunk_results = sql.get_query_results(database_path, query_str, [library_name] + chunk,
+                                              record=CollectionCandidate)
+        if chunk_results is None:
+            return None
+        results.extend(chunk_results)
+
+    return results
+
+
+def get_collection_part_guids(collection_part):
+    guids = []
+    if collection_part.get('imdb_id'):
+        guids.append(f"com.plexapp.agents.imdb://{collection_part['imdb_id']}?lang=en")
+    if collection_part.get('tmdb_id'):
+        guids.append(f"com.plexapp.agents.themoviedb://{collection_part['tmdb_id']}?lang=en")
+    return guids
+
+
+def resolve_collection_parts(database_path, library_name, collection_parts):
+    logger.debug(f"Resolving {len(collection_parts)} collection parts from library: {library_name!r}")
+
+    # lookup every candidate guid of every part at once
+    parts_guids = [get_collection_part_guids(collection_part) for collection_part in collection_parts]
+    results = get_metadata_items_by_guids(database_path, library_name,
+                                          [guid for part_guids in parts_guids for guid in part_guids])
+    if results is None:
+        return None
+
+    items_by_guid = {result.guid: result for result in results}
+
+    # map part index to the first matching item, imdb guid is preferred over the tmdb guid
+    resolved = {}
+    for part_index, part_guids in enumerate(parts_guids):
+        for guid in part_guids:
+            if guid in items_by_guid:
+                resolved[part_index] = items_by_guid[guid]
+                break
+
+    logger.debug(f"Resolved {len(resolved)} of {len(collection_parts)} collection parts from library: "
+                 f"{library_name!r}")
+    return resolved
+
+
 def get_metadata_item_of_collection(database_path, library_name, collection_name):
     logger.debug(f"Finding metadata_item details from library {library_name!r} for collection: {collection_name!r}")
 
@@ -108,6 +510,7 @@ def get_metadata_item_of_collection(database_path, library_name, collection_name
                     mi.id
                     , mi.guid
                     , mi.title
+                    , mi.user_thumb_url
                     FROM metadata_items mi
                     JOIN library_sections ls ON ls.id = mi.library_section_id
                     WHERE ls.name = ? and metadata_type = 18 AND mi.guid LIKE 'collection://%' 
@@ -115,3 +518,29 @@ def get_metadata_item_of_collection(database_path, library_name, collection_name
 
     # retrieve result
     return sql.get_query_result(database_path, query_str, [library_name, collection_name])
+
+
+def get_collection_tagged_item_ids(database_path, collection_name, metadata_item_ids):
+    logger.debug(f"Finding which of {len(metadata_item_ids)} metadata_items are tagged with collection: "
+                 f"{collection_name!r}")
+
+    tagged_item_ids = set()
+    metadata_item_ids = list(metadata_item_ids)
+    for chunk_start in range(0, len(metadata_item_ids), QUERY_CHUNK_SIZE):
+        chunk = metadata_item_ids[chunk_start:chunk_start + QUERY_CHUNK_SIZE]
+
+        # build query_str (tag_type 2 is a collection tag)
+        query_str = f"""SELECT
+                        tg.metadata_item_id
+                        FROM taggings tg
+                        JOIN tags t ON t.id = tg.tag_id
+                        WHERE t.tag_type = 2 AND t.tag = ?
+                        AND tg.metadata_item_id IN ({', '.join('?' * len(chunk))})"""
+
+        # retrieve results
+        results = sql.get_query_results(database_path, query_str, [collection_name] + chunk)
+        if results is None:
+            return None
+        tagged_item_ids.update(result['metadata_item_id'] for result in results)
+
+    return tagged_item_ids
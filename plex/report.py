@@ -0,0 +1,90 @@
+from loguru import logger
+
+from utils import sql
+from .metadata import sections_condition
+
+# columns of the library health report, in order
+REPORT_COLUMNS = ['items', 'missing_posters', 'missing_years', 'missing_guids', 'parts', 'unanalyzed_media',
+                  'zero_size_parts']
+
+REPORT_ITEMS_QUERY_STRING = """SELECT
+                    ls.name as library_name
+                    , md.metadata_type
+                    , md.year
+                    , md.guid
+                    , md.user_thumb_url
+                    FROM metadata_items md
+                    JOIN library_sections ls ON ls.id = md.library_section_id
+                    WHERE {sections}
+                    AND md.metadata_type = ls.section_type"""
+
+REPORT_PARTS_QUERY_STRING = """SELECT
+                    ls.name as library_name
+                    , mi.bitrate
+                    , mp.size
+                    FROM media_items mi
+                    JOIN media_parts mp ON mp.media_item_id = mi.id
+                    JOIN library_sections ls ON ls.id = mi.library_section_id
+                    WHERE {sections}"""
+
+
+def sum_by_library(frame, flags):
+    """Return the per library sum of the boolean columns flags of frame"""
+    return frame[['library_name'] + flags].groupby('library_name').sum()
+
+
+def item_flags(frame):
+    """Flag the items of a frame of REPORT_ITEMS_QUERY_STRING rows"""
+    thumb = frame['user_thumb_url']
+    # same rules as METADATA_MISSING_QUERY_STRINGS
+    frame['missing_posters'] = (thumb == '') | ((frame['metadata_type'] == 1) &
+                                                thumb.str.startswith('media://', na=False))
+    frame['missing_years'] = frame['year'].isna() | (frame['year'] == 0)
+    frame['missing_guids'] = frame['guid'].isna() | (frame['guid'] == '')
+    frame['items'] = True
+    return sum_by_library(frame, ['items', 'missing_posters', 'missing_years', 'missing_guids'])
+
+
+def part_flags(frame):
+    """Flag the media parts of a frame of REPORT_PARTS_QUERY_STRING rows"""
+    frame['unanalyzed_media'] = frame['bitrate'].isna()
+    frame['zero_size_parts'] = frame['size'] == 0
+    frame['parts'] = True
+    return sum_by_library(frame, ['parts', 'unanalyzed_media', 'zero_size_parts'])
+
+
+def get_libraries_report(database_path, libraries):
+    """
+    Return a DataFrame indexed by library name with the REPORT_COLUMNS health metrics of every library in libraries,
+    as returned by plex.library.find_libraries. Returns None on failure.
+
+    The items and media parts of all libraries are read in chunks with one query each, every chunk is flagged and
+    summed per library at once.
+    """
+    import pandas as pd
+
+    logger.debug(f"Building health report of {len(libraries)} libraries")
+    sections, section_ids = sections_condition(libraries)
+
+    totals = []
+    for query_str, flags in ((REPORT_ITEMS_QUERY_STRING, item_flags), (REPORT_PARTS_QUERY_STRING, part_flags)):
+        frames = sql.iter_query_frames(database_path, query_str.format(sections=sections), section_ids)
+        if frames is None:
+            return None
+
+        query_totals = None
+        try:
+            for frame in frames:
+                chunk_totals = flags(frame)
+                query_totals = (chunk_totals if query_totals is None
+                                else query_totals.add(chunk_totals, fill_value=0))
+        except sql.QueryError:
+            # a partial report would pass for a complete one
+            return None
+        if query_totals is not None:
+            totals.append(query_totals)
+
+    # libraries without any item still get a row
+    report = pd.concat(totals or [pd.DataFrame(columns=REPORT_COLUMNS)], axis=1, sort=False)
+    return report.reindex(index=[section['name'] for section in libraries], columns=REPORT_COLUMNS).fillna(0) \
+        .astype('int64')
@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+
+class Cache(object):
+    """
+    Persistent key/value cache of json serializable api responses stored in a local sqlite database
+    """
+
+    def __init__(self, cache_path, ttl=604800, max_entries=10000, refresh=False):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                            endpoint TEXT NOT NULL
+                            , key TEXT NOT NULL
+                            , value TEXT NOT NULL
+                            , created_at REAL NOT NULL
+                            , accessed_at REAL NOT NULL
+                            , PRIMARY KEY (endpoint, key))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self.conn.commit()
+
+    def get(self, endpoint, key, allow_stale=False):
+        """
+        Return the cached value of endpoint/key, or None when it is missing, expired or the cache is being refreshed.
+
+        A ttl of 0 or less never expires entries. allow_stale returns expired entries and ignores refresh.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value, created_at FROM cache WHERE endpoint = ? AND key = ?",
+                                    [endpoint, str(key)]).fetchone()
+
+            if row is None or (not allow_stale and (self.refresh or (
+                    self.ttl > 0 and row[1] + self.ttl < time.time()))):
+                self.misses += 1
+                logger.debug(f"Cache miss for {endpoint}/{key} (hits: {self.hits}, misses: {self.misses})")
+                return None
+
+            self.conn.execute("UPDATE cache SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                              [time.time(), endpoint, str(key)])
+            self.conn.commit()
+
+            self.hits += 1
+            logger.debug(f"Cache hit for {endpoint}/{key} (hits: {self.hits}, misses: {self.misses})")
+            return json.loads(row[0])
+
+    def set(self, endpoint, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (endpoint, key, value, created_at, accessed_at) "
+                              "VALUES (?, ?, ?, ?, ?)", [endpoint, str(key), json.dumps(value), now, now])
+
+            # evict the least recently used entries beyond max_entries
+            if self.max_entries > 0:
+                self.conn.execute("""DELETE FROM cache WHERE rowid IN (
+                                    SELECT rowid FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                                  [self.max_entries])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -33,7 +33,46 @@ class Config(object, metaclass=misc.Singleton):
         'plex': {
             'database_path': '',
             'url': 'https://plex.domain.com',
-            'token': ''
+            'token': '',
+            'pool_size': 10
+        },
+        # tmdb
+        'tmdb': {
+            'cache_path': '',
+            'cache_ttl': 604800,
+            'cache_max_entries': 10000
+        },
+        # snapshot
+        'snapshot': {
+            'path': '',
+            'max_age': 3600
+        },
+        # state
+        'state': {
+            'path': '',
+            'retry_delay': 3600
+        },
+        # scheduler
+        'scheduler': {
+            'target_latency': 30,
+            'max_error_rate': 0.2,
+            'window': 10,
+            'check_interval': 30,
+            'max_sessions': None,
+            'max_transcodes': None,
+            'max_activities': None
+        },
+        # preflight
+        'preflight': {
+            'path_mappings': {},
+            'workers': 16
+        },
+        # section refresh
+        'section_refresh': {
+            'min_items': 500,
+            'min_ratio': 0.5,
+            'verify_timeout': 900,
+            'settle_time': 60
         }
     })
 
@@ -0,0 +1,105 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from loguru import logger
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+def log_progress(results, total, started):
+    done = results['succeeded'] + len(results['failed'])
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed else 0.0
+
+    progress = f"{done}/{total}" if total else f"{done}"
+    if total and rate:
+        progress += f" ({done / total * 100:.1f}%, ETA {format_duration((total - done) / rate)})"
+
+    logger.info(f"Progress: {progress} - {results['succeeded']} succeeded, {len(results['failed'])} failed, "
+                f"{rate:.2f} items/s, elapsed {format_duration(elapsed)}")
+
+
+def dispatch(items, action, concurrency=1, total=None, describe=str, progress_interval=10, scheduler=None,
+             keep_succeeded=False):
+    """
+    Call action(item) for every item with at most concurrency calls in flight.
+
+    Items are consumed lazily, so items may be a generator. An item succeeds when action returns a truthy value.
+    With a scheduler, concurrency is the maximum and the scheduler paces the calls, items are no longer consumed
+    once its time budget is spent.
+    Returns a dict with the number of succeeded items, the failed items, the elapsed time in seconds and whether it
+    was stopped early. The succeeded items are only kept, as succeeded_items, when keep_succeeded.
+    """
+    results = {'succeeded': 0, 'succeeded_items': [], 'failed': [], 'elapsed': 0.0, 'stopped': False}
+    started = time.monotonic()
+    last_progress = started
+    concurrency = max(1, int(concurrency))
+
+    def current_concurrency():
+        return min(concurrency, scheduler.concurrency) if scheduler is not None else concurrency
+
+    def run_action(item):
+        action_started = time.monotonic()
+        succeeded = False
+        try:
+            succeeded = bool(action(item))
+        except Exception:
+            logger.exception(f"Exception processing item {describe(item)}: ")
+        if scheduler is not None:
+            scheduler.record(time.monotonic() - action_started, not succeeded)
+        return succeeded
+
+    def collect(done_futures):
+        for future in done_futures:
+            item = in_flight.pop(future)
+            if future.result():
+                results['succeeded'] += 1
+                if keep_succeeded:
+                    results['succeeded_items'].append(item)
+            else:
+                logger.warning(f"Failed processing item: {describe(item)}")
+                results['failed'].append(item)
+
+    in_flight = {}
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # wait for a free worker before taking more work
+            while len(in_flight) >= current_concurrency():
+                done_futures, _ = wait(in_flight, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                collect(done_futures)
+
+                if time.monotonic() - last_progress >= progress_interval:
+                    log_progress(results, total, started)
+                    last_progress = time.monotonic()
+
+            # only wait once there is an item to act on, so a run without work never waits
+            item = next(items, None)
+            if item is None:
+                break
+            if scheduler is not None and not scheduler.wait_until_ready():
+                results['stopped'] = True
+                break
+            in_flight[executor.submit(run_action, item)] = item
+
+        # drain remaining work
+        while in_flight:
+            done_futures, _ = wait(in_flight, timeout=progress_interval, return_when=FIRST_COMPLETED)
+            collect(done_futures)
+
+            if time.monotonic() - last_progress >= progress_interval:
+                log_progress(results, total, started)
+                last_progress = time.monotonic()
+
+    results['elapsed'] = time.monotonic() - started
+    log_progress(results, total, started)
+    return results
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from loguru import logger
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+PROMETHEUS_PREFIX = 'plex_db_tools'
+
+_operations = OrderedDict()
+_lock = threading.Lock()
+_started = time.time()
+
+
+def record(kind, operation, elapsed, error=False, size=0):
+    """Record one call of operation, kind is the backend it ran against (sql, plex or tmdb)"""
+    with _lock:
+        stats = _operations.get((kind, operation))
+        if stats is None:
+            stats = _operations[(kind, operation)] = {
+                'count': 0,
+                'errors': 0,
+                'bytes': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            }
+
+        stats['count'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['bytes'] += size
+        stats['seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                stats['buckets'][index] += 1
+                break
+
+
+@contextmanager
+def timer(kind, operation):
+    """
+    Time the enclosed block as one call of operation.
+
+    Yields a dict, set its 'error' to flag the call as failed and its 'bytes' to the size of the payload.
+    An exception raised by the block is always recorded as an error.
+    """
+    result = {'error': False, 'bytes': 0}
+    started = time.perf_counter()
+    try:
+        yield result
+    except Exception:
+        result['error'] = True
+        raise
+    finally:
+        record(kind, operation, time.perf_counter() - started, result['error'], result['bytes'])
+
+
+def snapshot():
+    with _lock:
+        return [(kind, operation, dict(stats, buckets=list(stats['buckets'])))
+                for (kind, operation), stats in _operations.items()]
+
+
+def to_json(command=None):
+    operations = []
+    for kind, operation, stats in snapshot():
+        operations.append({
+            'kind': kind,
+            'operation': operation,
+            'count': stats['count'],
+            'errors': stats['errors'],
+            'bytes': stats['bytes'],
+            'seconds': round(stats['seconds'], 6),
+            'mean_seconds': round(stats['seconds'] / stats['count'], 6) if stats['count'] else 0.0,
+            'max_seconds': round(stats['max_seconds'], 6),
+            'buckets': OrderedDict((str(bound), count) for bound, count in zip(LATENCY_BUCKETS, stats['buckets'])),
+        })
+
+    return json.dumps({
+        'command': command,
+        'started': _started,
+        'finished': time.time(),
+        'operations': operations,
+    }, indent=2)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(command=None):
+    histogram = f"{PROMETHEUS_PREFIX}_operation_duration_seconds"
+    lines = [
+        f"# HELP {histogram} Latency of sql queries and http requests.",
+        f"# TYPE {histogram} histogram",
+    ]
+    errors, sizes = [], []
+    for kind, operation, stats in snapshot():
+        labels = f'command="{escape_label(command or "")}",kind="{escape_label(kind)}",' \
+                 f'operation="{escape_label(operation)}"'
+
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+            cumulative += count
+            lines.append(f'{histogram}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{histogram}_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+        lines.append(f"{histogram}_sum{{{labels}}} {stats['seconds']:.6f}")
+        lines.append(f"{histogram}_count{{{labels}}} {stats['count']}")
+
+        errors.append(f"{PROMETHEUS_PREFIX}_operation_errors_total{{{labels}}} {stats['errors']}")
+        sizes.append(f"{PROMETHEUS_PREFIX}_operation_bytes_total{{{labels}}} {stats['bytes']}")
+
+    lines += [f"# HELP {PROMETHEUS_PREFIX}_operation_errors_total Failed sql queries and http requests.",
+              f"# TYPE {PROMETHEUS_PREFIX}_operation_errors_total counter"] + errors
+    lines += [f"# HELP {PROMETHEUS_PREFIX}_operation_bytes_total Bytes received by http requests.",
+              f"# TYPE {PROMETHEUS_PREFIX}_operation_bytes_total counter"] + sizes
+    lines += [f"# HELP {PROMETHEUS_PREFIX}_last_run_timestamp_seconds Time the last run finished.",
+              f"# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge",
+              f'{PROMETHEUS_PREFIX}_last_run_timestamp_seconds{{command="{escape_label(command or "")}"}} '
+              f'{time.time():.3f}']
+    return '\n'.join(lines) + '\n'
+
+
+def dump(metrics_path, command=None):
+    """Write the recorded metrics to metrics_path, in the prometheus text format when it ends with .prom"""
+    try:
+        output = to_prometheus(command) if metrics_path.endswith('.prom') else to_json(command)
+
+        # write atomically so collectors never read a partial file
+        tmp_path = f"{metrics_path}.tmp"
+        with open(tmp_path, 'w') as fp:
+            fp.write(output)
+        os.replace(tmp_path, metrics_path)
+        logger.debug(f"Dumped metrics to: {metrics_path!r}")
+    except Exception:
+        logger.exception(f"Exception dumping metrics to {metrics_path!r}: ")
@@ -3,6 +3,7 @@ try:
 except ImportError:
     from pipes import quote as cmd_quote
 
+import time
 from urllib.parse import urljoin
 
 
@@ -35,3 +36,31 @@ def dict_contains_keys(dict_to_check, keys):
         if key not in dict_to_check:
             return False
     return True
+
+
+def wait_for(condition, timeout=60, initial_delay=0.1, max_delay=5.0, backoff=2.0):
+    """
+    Poll condition() with exponential backoff until it returns a truthy value or timeout seconds have passed.
+
+    Returns the truthy value returned by condition(), or None when the deadline was reached.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        result = condition()
+        if result:
+            return result
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * backoff, max_delay)
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1024 or unit == 'TB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
@@ -0,0 +1,92 @@
+import csv
+import json
+
+from loguru import logger
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+
+# rows buffered per parquet row group, bounds the memory used while writing
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+class JsonLinesWriter(object):
+    def __init__(self, path, fields):
+        self.fields = fields
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        self.file.write(json.dumps(dict(zip(self.fields, row))) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter(object):
+    def __init__(self, path, fields):
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fields)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(object):
+    """Writes rows in row groups of PARQUET_ROW_GROUP_SIZE rows, so only one row group is held in memory"""
+
+    def __init__(self, path, fields, types):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+        self.fields = fields
+        self.schema = pa.schema([(field, arrow_types[types.get(field, str)]) for field in fields])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+        import pyarrow as pa
+
+        # object columns keep missing integers as None instead of turning the column into floats
+        frame = pd.DataFrame(self.rows, columns=self.fields, dtype=object)
+        self.writer.write_table(pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False))
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.flush()
+        self.writer.close()
+
+
+def open_writer(output_format, path, fields, types=None):
+    """
+    Open a writer streaming rows with the given fields to path, types maps fields to int, float or str and types the
+    parquet columns. Returns None when the writer could not be opened.
+    """
+    try:
+        if output_format == 'jsonl':
+            writer = JsonLinesWriter(path, fields)
+        elif output_format == 'csv':
+            writer = CsvWriter(path, fields)
+        elif output_format == 'parquet':
+            writer = ParquetWriter(path, fields, types or {})
+        else:
+            logger.error(f"Unsupported output format: {output_format!r}")
+            return None
+
+        logger.debug(f"Writing {output_format} output to: {path!r}")
+        return writer
+    except ImportError:
+        logger.error("Writing parquet output requires pyarrow, install it with: pip install pyarrow")
+    except Exception:
+        logger.exception(f"Exception opening {output_format} output: {path!r}")
+    return None
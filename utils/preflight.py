@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import metrics
+
+ANALYZABLE = 'analyzable'
+MISSING = 'missing'
+SIZE_MISMATCH = 'size_mismatch'
+
+# checks queued per worker, bounds how far ahead of the consumer items are read
+QUEUED_PER_WORKER = 4
+
+
+def map_path(path, path_mappings):
+    """Map a path as seen by the Plex Media Server to the local path, using the longest matching prefix"""
+    for plex_prefix in sorted(path_mappings or {}, key=len, reverse=True):
+        if path.startswith(plex_prefix):
+            return path_mappings[plex_prefix] + path[len(plex_prefix):]
+    return path
+
+
+def check_file(path, expected_size=None):
+    """Return the status of the file at path and its size, the size is only compared when expected_size is known"""
+    with metrics.timer('fs', 'stat') as timing:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            timing['error'] = True
+            return MISSING, None
+
+    if expected_size and size != expected_size:
+        return SIZE_MISMATCH, size
+    return ANALYZABLE, size
+
+
+def iter_checked(items, get_path, get_size, path_mappings=None, workers=16):
+    """
+    Stat the file of every item with a pool of workers, yielding (item, status, local path, size) as checks complete.
+
+    Items are consumed lazily, at most workers * QUEUED_PER_WORKER checks are queued at once.
+    """
+    workers = max(1, int(workers))
+
+    def check_item(item):
+        local_path = map_path(get_path(item), path_mappings)
+        return (item, local_path) + check_file(local_path, get_size(item))
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            in_flight.add(executor.submit(check_item, item))
+            if len(in_flight) < workers * QUEUED_PER_WORKER:
+                continue
+
+            done_futures, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                item, local_path, status, size = future.result()
+                yield item, status, local_path, size
+
+        # drain remaining checks
+        while in_flight:
+            done_futures, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                item, local_path, status, size = future.result()
+                yield item, status, local_path, size
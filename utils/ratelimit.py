@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing rate acquisitions per second with bursts of up to capacity
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        """Drain the bucket so no acquisition succeeds for the next seconds"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, 0.0) - seconds * self.rate
+            self.updated = now
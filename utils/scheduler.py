@@ -0,0 +1,142 @@
+import re
+import threading
+import time
+
+from loguru import logger
+
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """Parse a duration like 90, 45m, 2h or 1h30m into seconds, raises ValueError when invalid"""
+    value = value.replace(' ', '').lower()
+    if not re.fullmatch(r'(\d+[smhd]?)+', value):
+        raise ValueError(f"Invalid duration: {value!r}")
+    return sum(int(amount) * DURATION_UNITS[unit] for amount, unit in re.findall(r'(\d+)([smhd]?)', value))
+
+
+def parse_allowed_hours(value):
+    """Parse hour windows like 1-6 or 22-6,12-14 into a list of (start, end) hours, raises ValueError when invalid"""
+    windows = []
+    for window in value.replace(' ', '').split(','):
+        match = re.fullmatch(r'(\d{1,2})-(\d{1,2})', window)
+        if not match:
+            raise ValueError(f"Invalid hours window: {window!r}")
+
+        start, end = int(match.group(1)), int(match.group(2))
+        if start > 23 or end > 24 or start == end % 24:
+            raise ValueError(f"Invalid hours window: {window!r}")
+        windows.append((start, end))
+    return windows
+
+
+def in_allowed_hours(allowed_hours, hour):
+    for start, end in allowed_hours:
+        # windows ending before they start wrap around midnight
+        if start < end and start <= hour < end:
+            return True
+        if start > end and (hour >= start or hour < end):
+            return True
+    return False
+
+
+class AdaptiveScheduler(object):
+    """
+    Paces the actions sent to the Plex Media Server.
+
+    When adaptive, the concurrency starts at 1 and is adjusted with additive increase and multiplicative decrease
+    from the latency and error rate of every window of completed actions. Actions are held back while outside the
+    allowed hours or while load_check reports the server as busy, and stop once the max_duration budget is spent.
+    """
+
+    def __init__(self, max_concurrency=1, adaptive=False, target_latency=30.0, max_error_rate=0.2, window=10,
+                 max_duration=None, allowed_hours=None, load_check=None, check_interval=30.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.adaptive = adaptive
+        self.concurrency = 1 if adaptive else self.max_concurrency
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = max(1, int(window))
+        self.deadline = time.monotonic() + max_duration if max_duration else None
+        self.allowed_hours = allowed_hours
+        self.load_check = load_check
+        self.check_interval = check_interval
+
+        self.samples = []
+        self.stopped = False
+        self.busy_reason = None
+        self.next_load_check = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, error):
+        """Record a completed action, adjusting the concurrency once a window of actions completed"""
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            self.samples.append((elapsed, error))
+            if len(self.samples) < self.window:
+                return
+
+            mean_latency = sum(sample[0] for sample in self.samples) / len(self.samples)
+            error_rate = sum(1 for sample in self.samples if sample[1]) / len(self.samples)
+            self.samples = []
+
+            if mean_latency > self.target_latency or error_rate > self.max_error_rate:
+                concurrency = max(1, self.concurrency // 2)
+            else:
+                concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+            if concurrency != self.concurrency:
+                logger.info(f"Adjusting concurrency from {self.concurrency} to {concurrency}, mean latency "
+                            f"{mean_latency:.2f}s, error rate {error_rate:.0%}")
+                self.concurrency = concurrency
+
+    def remaining(self):
+        """Seconds left of the time budget, or None without a budget"""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def pause_reason(self):
+        if self.allowed_hours and not in_allowed_hours(self.allowed_hours, time.localtime().tm_hour):
+            return "outside of the allowed hours"
+
+        # only ask the server for its load every check_interval seconds
+        if self.load_check is not None and time.monotonic() >= self.next_load_check:
+            self.busy_reason = self.load_check()
+            self.next_load_check = time.monotonic() + self.check_interval
+            if self.busy_reason and self.adaptive:
+                with self.lock:
+                    if self.concurrency > 1:
+                        logger.info(f"Resetting concurrency from {self.concurrency} to 1, the server is busy")
+                        self.concurrency = 1
+        return self.busy_reason
+
+    def wait_until_ready(self):
+        """Block while actions are held back, returns False once the time budget is spent"""
+        paused_reason = None
+        while True:
+            if self.remaining() == 0:
+                if not self.stopped:
+                    logger.info("The time budget is spent, no more actions will be sent")
+                self.stopped = True
+                return False
+
+            reason = self.pause_reason()
+            if reason is None:
+                if paused_reason:
+                    logger.info("Resuming actions")
+                return True
+
+            if reason != paused_reason:
+                logger.info(f"Pausing actions, {reason}")
+                paused_reason = reason
+
+            remaining = self.remaining()
+            time.sleep(self.check_interval if remaining is None else min(self.check_interval, remaining))
+
+    def iter_ready(self, items):
+        """Yield items while actions are allowed, only waiting once there is an item to act on"""
+        for item in items:
+            if not self.wait_until_ready():
+                return
+            yield item
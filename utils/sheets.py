@@ -28,15 +28,17 @@ def get_sheets_collection(id):
             'overview': collection_summary,
             'parts': []
         }
+        tmdb_ids = []
         for collection_part in collection_parts:
             # validate tmdb id is valid
             trimmed_tmdb_id = collection_part.strip()
             if not trimmed_tmdb_id.isalnum():
                 logger.error(f"Collection {collection_name!r} had an invalid part: {trimmed_tmdb_id!r}")
                 continue
+            tmdb_ids.append(trimmed_tmdb_id)
 
-            # lookup tmdb movie details
-            movie_details = themoviedb.get_tmdb_id_details(trimmed_tmdb_id)
+        # lookup tmdb movie details
+        for movie_details in themoviedb.get_tmdb_movies_details(tmdb_ids):
             if movie_details is not None:
                 collection_details['parts'].append(movie_details)
 
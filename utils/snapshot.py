@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+from loguru import logger
+
+# indexes suited to the plex.metadata queries, only ever created on the snapshot
+SNAPSHOT_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS pdt_metadata_items_missing_posters
+       ON metadata_items (library_section_id, metadata_type, added_at, user_thumb_url, guid, title, year)""",
+    """CREATE INDEX IF NOT EXISTS pdt_metadata_items_guid
+       ON metadata_items (guid, library_section_id, metadata_type, title, year)""",
+    """CREATE INDEX IF NOT EXISTS pdt_media_items_unanalyzed
+       ON media_items (library_section_id, metadata_item_id) WHERE bitrate IS NULL""",
+    """CREATE INDEX IF NOT EXISTS pdt_media_parts_media_item
+       ON media_parts (media_item_id, file, size)""",
+]
+
+# tables to gather planner statistics for, avoiding Plex's fts tables and their custom tokenizers
+SNAPSHOT_ANALYZE_TABLES = ['library_sections', 'metadata_items', 'media_items', 'media_parts']
+
+
+def snapshot_age(snapshot_path):
+    """Return the age of the snapshot in seconds, or None when there is no snapshot"""
+    try:
+        return time.time() - os.path.getmtime(snapshot_path)
+    except OSError:
+        return None
+
+
+def create_snapshot(database_path, snapshot_path):
+    logger.info(f"Creating snapshot of {database_path!r} at: {snapshot_path!r}")
+    started = time.monotonic()
+    tmp_path = f"{snapshot_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    # copy the live database with the online backup api in a single step, it reads from one consistent snapshot
+    # while the Plex Media Server keeps writing, a stepped backup restarts whenever the source changes between steps
+    source_uri = f"{Path(os.path.abspath(database_path)).as_uri()}?mode=ro"
+    with closing(sqlite3.connect(source_uri, uri=True)) as source, closing(sqlite3.connect(tmp_path)) as snapshot:
+        source.backup(snapshot, pages=-1)
+        logger.debug(f"Copied database in {time.monotonic() - started:.1f}s, building indexes")
+
+        # build the indexes we need, the snapshot is ours to write
+        snapshot.execute("PRAGMA journal_mode = DELETE")
+        for index_str in SNAPSHOT_INDEXES:
+            logger.trace(f"Creating snapshot index: {index_str!r}")
+            snapshot.execute(index_str)
+        for table_name in SNAPSHOT_ANALYZE_TABLES:
+            snapshot.execute(f"ANALYZE {table_name}")
+        snapshot.commit()
+
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"Created snapshot in {time.monotonic() - started:.1f}s")
+
+
+def get_snapshot(database_path, snapshot_path, max_age):
+    """
+    Return the path of a snapshot of database_path no older than max_age seconds, refreshing it when needed.
+
+    Returns None when the snapshot could not be created.
+    """
+    age = snapshot_age(snapshot_path)
+    if age is not None and age <= max_age:
+        logger.info(f"Using snapshot {snapshot_path!r} from {int(age)}s ago")
+        return snapshot_path
+
+    try:
+        create_snapshot(database_path, snapshot_path)
+        return snapshot_path
+    except Exception:
+        logger.exception(f"Exception creating snapshot of {database_path!r} at {snapshot_path!r}: ")
+    return None
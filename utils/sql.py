@@ -1,24 +1,105 @@
+import atexit
+import os
 import sqlite3
-from contextlib import closing
+import sys
+import threading
+import time
+from contextlib import closing, suppress
+from pathlib import Path
 
 from loguru import logger
 
+from . import metrics
 
-def get_query_results(database_path, query_str, query_args):
+# number of prepared statements kept per connection
+CACHED_STATEMENTS = 256
+# number of rows fetched at a time when streaming query results
+FETCH_CHUNK_SIZE = 500
+# number of rows per DataFrame when streaming query results as DataFrames
+FRAME_CHUNK_SIZE = 50000
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class QueryError(Exception):
+    """Raised when a query fails after its results started streaming, so a partial result is never taken as whole"""
+
+
+class Database(object):
+    """
+    Persistent read-only connection to a sqlite database, shared by every query in the process
+    """
+
+    def __init__(self, database_path):
+        self.database_path = os.path.abspath(database_path)
+        self.lock = threading.RLock()
+
+        # open in read-only uri mode so we never contend for write locks with the Plex Media Server
+        database_uri = f"{Path(self.database_path).as_uri()}?mode=ro"
+        logger.debug(f"Opening read-only database connection to: {database_uri}")
+        self.conn = sqlite3.connect(database_uri, uri=True, check_same_thread=False,
+                                    cached_statements=CACHED_STATEMENTS)
+        self.conn.row_factory = sqlite3.Row
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_database(database_path):
+    key = os.path.abspath(database_path)
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = Database(key)
+        return _connections[key]
+
+
+def close_databases():
+    with _connections_lock:
+        for database in _connections.values():
+            try:
+                database.close()
+            except Exception:
+                logger.exception(f"Exception closing database connection to {database.database_path!r}: ")
+        _connections.clear()
+
+
+atexit.register(close_databases)
+
+
+def get_record_cursor(database, record):
+    """Return a cursor producing dict-like rows, or instances of the namedtuple record when given"""
+    cursor = database.conn.cursor()
+    if record is not None:
+        cursor.row_factory = None
+    return cursor
+
+
+def to_result(row, record):
+    return record._make(row) if record is not None else dict(row)
+
+
+def caller_name():
+    """Name of the function calling the query helper, used to label its metrics"""
+    return sys._getframe(2).f_code.co_name
+
+
+def get_query_results(database_path, query_str, query_args, record=None, query_name=None):
     logger.trace(f"Running query {query_str!r} with args: {query_args}")
     try:
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            with closing(conn.cursor()) as c:
-                query_results = c.execute(query_str, query_args).fetchall()
-                if not query_results:
-                    logger.debug(f"No results were found from query")
-                    return []
-
-                results = [dict(result) for result in query_results]
-                logger.debug(f"Found {len(results)} results from query")
-                logger.trace(results)
-                return results
+        database = get_database(database_path)
+        with metrics.timer('sql', query_name or caller_name()), database.lock, \
+                closing(get_record_cursor(database, record)) as c:
+            query_results = c.execute(query_str, query_args).fetchall()
+            if not query_results:
+                logger.debug(f"No results were found from query")
+                return []
+
+            results = [to_result(result, record) for result in query_results]
+            logger.debug(f"Found {len(results)} results from query")
+            logger.trace(results)
+            return results
     except Exception:
         logger.exception(f"Exception running query {query_str!r}: ")
     return None
@@ -27,17 +108,136 @@ def get_query_results(database_path, query_str, query_args):
 def get_query_result(database_path, query_str, query_args):
     logger.trace(f"Running query {query_str!r} with args: {query_args}")
     try:
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            with closing(conn.cursor()) as c:
-                query_result = c.execute(query_str, query_args).fetchone()
-                if not query_result:
-                    logger.debug(f"No result was found from query")
-                    return {}
-
-                result = dict(query_result)
-                logger.trace(f"Found result: {result}")
-                return result
+        database = get_database(database_path)
+        with metrics.timer('sql', caller_name()), database.lock, closing(database.conn.cursor()) as c:
+            query_result = c.execute(query_str, query_args).fetchone()
+            if not query_result:
+                logger.debug(f"No result was found from query")
+                return {}
+
+            result = dict(query_result)
+            logger.trace(f"Found result: {result}")
+            return result
     except Exception:
         logger.exception(f"Exception running query {query_str!r}: ")
     return None
+
+
+def get_data_version(database_path):
+    """
+    Return the data_version of the database, it changes whenever another connection commits a change to it.
+    Returns None when it could not be read.
+    """
+    try:
+        database = get_database(database_path)
+        with database.lock:
+            return database.conn.execute("PRAGMA data_version").fetchone()[0]
+    except Exception:
+        logger.exception(f"Exception reading data_version of database {database_path!r}: ")
+    return None
+
+
+def iter_query_results(database_path, query_str, query_args, record=None, chunk_size=FETCH_CHUNK_SIZE,
+                       query_name=None):
+    """
+    Run a query and return a generator streaming its rows, fetching chunk_size rows at a time.
+
+    The statement, and its read transaction, stays open until the stream ends, so only use it for results consumed
+    without waiting on the Plex Media Server or the user. A failure while streaming raises QueryError.
+    Rows are dicts, or instances of the namedtuple record when given, its fields must match the selected columns.
+    query_name labels the query metrics, defaulting to the name of the calling function.
+    Returns None when the query could not be run.
+    """
+    logger.trace(f"Running query {query_str!r} with args: {query_args}")
+    query_name = query_name or caller_name()
+    started = time.perf_counter()
+    try:
+        database = get_database(database_path)
+        with database.lock:
+            cursor = get_record_cursor(database, record)
+            cursor.execute(query_str, query_args)
+    except Exception:
+        metrics.record('sql', query_name, time.perf_counter() - started, error=True)
+        logger.exception(f"Exception running query {query_str!r}: ")
+        return None
+
+    return iter_cursor_results(database, cursor, query_str, record, chunk_size, query_name,
+                               time.perf_counter() - started)
+
+
+def iter_cursor_results(database, cursor, query_str, record, chunk_size, query_name, elapsed):
+    """Stream the rows of an executed cursor, recording the time spent in sqlite once the stream ends"""
+    total = 0
+    error = False
+    try:
+        while True:
+            started = time.perf_counter()
+            with database.lock:
+                query_results = cursor.fetchmany(chunk_size)
+            elapsed += time.perf_counter() - started
+            if not query_results:
+                break
+
+            total += len(query_results)
+            for result in query_results:
+                yield to_result(result, record)
+    except Exception as e:
+        error = True
+        logger.exception(f"Exception streaming results of query {query_str!r}: ")
+        raise QueryError(f"Failed streaming results of query {query_name!r}") from e
+    finally:
+        metrics.record('sql', query_name, elapsed, error=error)
+        # the connection may already be closed when an unfinished generator is collected at exit
+        with suppress(sqlite3.ProgrammingError):
+            cursor.close()
+        logger.debug(f"Streamed {total} results from query")
+
+
+def iter_query_frames(database_path, query_str, query_args, chunk_size=FRAME_CHUNK_SIZE, query_name=None):
+    """
+    Run a query with pandas.read_sql and return a generator streaming its rows as DataFrames of chunk_size rows.
+
+    A failure while streaming raises QueryError.
+    query_name labels the query metrics, defaulting to the name of the calling function.
+    Returns None when the query could not be run.
+    """
+    import pandas as pd
+
+    logger.trace(f"Running query {query_str!r} with args: {query_args}")
+    query_name = query_name or caller_name()
+    started = time.perf_counter()
+    try:
+        database = get_database(database_path)
+        with database.lock:
+            frames = pd.read_sql(query_str, database.conn, params=query_args, chunksize=chunk_size)
+    except Exception:
+        metrics.record('sql', query_name, time.perf_counter() - started, error=True)
+        logger.exception(f"Exception running query {query_str!r}: ")
+        return None
+
+    return iter_frames(database, frames, query_str, query_name, time.perf_counter() - started)
+
+
+def iter_frames(database, frames, query_str, query_name, elapsed):
+    """Stream the DataFrames of pandas.read_sql, fetching each one under the database lock"""
+    total = 0
+    error = False
+    try:
+        while True:
+            started = time.perf_counter()
+            with database.lock:
+                frame = next(frames, None)
+            elapsed += time.perf_counter() - started
+            if frame is None:
+                break
+
+            total += len(frame)
+            yield frame
+    except Exception as e:
+        error = True
+        logger.exception(f"Exception streaming results of query {query_str!r}: ")
+        raise QueryError(f"Failed streaming results of query {query_name!r}") from e
+    finally:
+        metrics.record('sql', query_name, elapsed, error=error)
+        frames.close()
+        logger.debug(f"Streamed {total} results from query")
@@ -0,0 +1,212 @@
+import json
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+# failed items are retried after retry_delay * 2 ^ (attempts - 1) seconds, up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 7 * 86400
+# number of queued items read at a time
+QUEUE_PAGE_SIZE = 500
+
+
+class StateStore(object):
+    """
+    Local sqlite store of per library scan high-water marks, item outcomes and the queue of items to act on
+    """
+
+    def __init__(self, state_path, retry_delay=3600):
+        self.state_path = state_path
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(state_path, check_same_thread=False)
+        # queue checkpoints are committed per item, keep those commits cheap
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS marks (
+                scan TEXT NOT NULL
+                , library TEXT NOT NULL
+                , mark TEXT NOT NULL
+                , updated_at REAL NOT NULL
+                , PRIMARY KEY (scan, library));
+            CREATE TABLE IF NOT EXISTS outcomes (
+                scan TEXT NOT NULL
+                , library TEXT NOT NULL
+                , item_id INTEGER NOT NULL
+                , status TEXT NOT NULL
+                , attempts INTEGER NOT NULL DEFAULT 0
+                , updated_at REAL NOT NULL
+                , retry_at REAL
+                , PRIMARY KEY (scan, library, item_id));
+            CREATE INDEX IF NOT EXISTS outcomes_retry ON outcomes (scan, library, status, retry_at);
+            CREATE TABLE IF NOT EXISTS queue (
+                scan TEXT NOT NULL
+                , library TEXT NOT NULL
+                , item_id INTEGER NOT NULL
+                , item TEXT NOT NULL
+                , status TEXT NOT NULL
+                , attempts INTEGER NOT NULL DEFAULT 0
+                , run_id INTEGER
+                , enqueued_at REAL NOT NULL
+                , updated_at REAL NOT NULL
+                , retry_at REAL
+                , PRIMARY KEY (scan, library, item_id));
+            CREATE INDEX IF NOT EXISTS queue_status ON queue (scan, status, library);
+            CREATE INDEX IF NOT EXISTS queue_run ON queue (run_id);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT
+                , scan TEXT NOT NULL
+                , started_at REAL NOT NULL
+                , finished_at REAL);""")
+        self.conn.commit()
+
+    def get_mark(self, scan, library):
+        """Return the high-water mark of the last run of scan on library, or None when it never ran"""
+        with self.lock:
+            row = self.conn.execute("SELECT mark FROM marks WHERE scan = ? AND library = ?", [scan, library]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_mark(self, scan, library, mark):
+        logger.debug(f"Setting {scan!r} high-water mark of library {library!r} to: {mark!r}")
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO marks (scan, library, mark, updated_at) VALUES (?, ?, ?, ?)",
+                              [scan, library, json.dumps(mark), time.time()])
+            self.conn.commit()
+
+    def record_outcomes(self, scan, library, item_ids, status):
+        """Record the outcome of items, failed items are scheduled for a retry with exponential backoff"""
+        now = time.time()
+        with self.lock:
+            for item_id in item_ids:
+                row = self.conn.execute("SELECT attempts FROM outcomes WHERE scan = ? AND library = ? AND item_id = ?",
+                                        [scan, library, item_id]).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                retry_at = None
+                if status == 'failed':
+                    retry_at = self.retry_at(attempts, now)
+
+                self.conn.execute("INSERT OR REPLACE INTO outcomes (scan, library, item_id, status, attempts, "
+                                  "updated_at, retry_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [scan, library, item_id, status, attempts, now, retry_at])
+            self.conn.commit()
+
+    def get_retry_item_ids(self, scan, library):
+        """Return the ids of the failed items of library whose retry delay has passed"""
+        with self.lock:
+            rows = self.conn.execute("SELECT item_id FROM outcomes WHERE scan = ? AND library = ? "
+                                     "AND status = 'failed' AND retry_at <= ? ORDER BY item_id",
+                                     [scan, library, time.time()]).fetchall()
+        return [row[0] for row in rows]
+
+    def retry_at(self, attempts, now):
+        return now + min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+    def start_run(self, scan):
+        with self.lock:
+            run_id = self.conn.execute("INSERT INTO runs (scan, started_at) VALUES (?, ?)",
+                                       [scan, time.time()]).lastrowid
+            self.conn.commit()
+        return run_id
+
+    def finish_run(self, run_id):
+        with self.lock:
+            self.conn.execute("UPDATE runs SET finished_at = ? WHERE id = ?", [time.time(), run_id])
+            self.conn.commit()
+
+    def count_queued(self, scan, libraries):
+        """Return the number of items of libraries still pending in the queue of scan"""
+        with self.lock:
+            row = self.conn.execute(f"SELECT COUNT(*) FROM queue WHERE scan = ? AND status = 'pending' "
+                                    f"AND library IN ({', '.join('?' * len(libraries))})",
+                                    [scan] + list(libraries)).fetchone()
+        return row[0]
+
+    def enqueue(self, scan, items):
+        """
+        Queue items, tuples of library, item id and a json serializable item, as pending.
+
+        Items that were acted on before are only queued again once their retry time has passed.
+        Returns the number of items queued.
+        """
+        now = time.time()
+        queued = 0
+        with self.lock:
+            for item_library, item_id, item in items:
+                queued += self.conn.execute(
+                    "INSERT INTO queue (scan, library, item_id, item, status, enqueued_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?, ?) "
+                    "ON CONFLICT (scan, library, item_id) DO UPDATE SET item = excluded.item, status = 'pending', "
+                    "enqueued_at = excluded.enqueued_at, updated_at = excluded.updated_at "
+                    "WHERE queue.status != 'pending' AND (queue.retry_at IS NULL OR queue.retry_at <= ?)",
+                    [scan, item_library, item_id, json.dumps(item), now, now, now]).rowcount
+            self.conn.commit()
+        return queued
+
+    def iter_queued(self, scan, libraries):
+        """Stream the pending items of libraries in the queue of scan, in the order they were first queued"""
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT rowid, item FROM queue WHERE scan = ? AND status = 'pending' AND rowid > ? "
+                    f"AND library IN ({', '.join('?' * len(libraries))}) ORDER BY rowid LIMIT ?",
+                    [scan, last_rowid] + list(libraries) + [QUEUE_PAGE_SIZE]).fetchall()
+            if not rows:
+                return
+
+            for rowid, item in rows:
+                last_rowid = rowid
+                yield json.loads(item)
+
+    def complete_queued(self, scan, library, item_id, run_id, status):
+        """
+        Checkpoint a queued item as done, failed or skipped.
+
+        Done items are not queued again for retry_delay seconds, failed items back off exponentially.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT attempts FROM queue WHERE scan = ? AND library = ? AND item_id = ?",
+                                    [scan, library, item_id]).fetchone()
+            attempts, retry_at = 0, None
+            if status == 'failed':
+                attempts = (row[0] if row else 0) + 1
+                retry_at = self.retry_at(attempts, now)
+            elif status == 'done':
+                retry_at = now + self.retry_delay
+
+            self.conn.execute("UPDATE queue SET status = ?, attempts = ?, run_id = ?, updated_at = ?, retry_at = ? "
+                              "WHERE scan = ? AND library = ? AND item_id = ?",
+                              [status, attempts, run_id, now, retry_at, scan, library, item_id])
+            self.conn.commit()
+
+    def get_queue_status(self):
+        """Return the number of queued items per scan, library and status, and how many are waiting for a retry"""
+        with self.lock:
+            rows = self.conn.execute("SELECT scan, library, status, COUNT(*), SUM(retry_at > ?) FROM queue "
+                                     "GROUP BY scan, library, status ORDER BY scan, library, status",
+                                     [time.time()]).fetchall()
+        return [{'scan': scan, 'library': library, 'status': status, 'items': items, 'waiting': waiting or 0}
+                for scan, library, status, items, waiting in rows]
+
+    def get_last_runs(self):
+        """Return the last run of every scan with the number of items it processed and when it last made progress"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT r.scan, r.started_at, r.finished_at, COUNT(q.item_id), MAX(q.updated_at)
+                , SUM(q.status = 'done'), SUM(q.status = 'failed')
+                FROM runs r
+                LEFT JOIN queue q ON q.run_id = r.id
+                WHERE r.id IN (SELECT MAX(id) FROM runs GROUP BY scan)
+                GROUP BY r.id
+                ORDER BY r.scan""").fetchall()
+        return [{'scan': scan, 'started_at': started_at, 'finished_at': finished_at, 'items': items,
+                 'last_progress_at': last_progress_at, 'done': done or 0, 'failed': failed or 0}
+                for scan, started_at, finished_at, items, last_progress_at, done, failed in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
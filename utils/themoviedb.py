@@ -1,12 +1,94 @@
+import atexit
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 import tmdbsimple as tmdb
 from loguru import logger
 
-from . import misc
+from . import misc, metrics
+from .cache import Cache
+from .ratelimit import TokenBucket
 
 TMDB_KEY = 'da6bf4ac38be518f95bbb3c309fad7b9'
 
+# stay below the Tmdb request rate limit of ~50 requests per second
+TMDB_RATE_LIMIT = 40
+TMDB_MAX_RETRIES = 5
+TMDB_CONCURRENCY = 8
+
+rate_limiter = TokenBucket(TMDB_RATE_LIMIT)
+
+# optional persistent response cache, see init_cache
+cache = None
+
+
+def init_cache(cache_path, ttl, max_entries, refresh=False):
+    global cache
+    logger.debug(f"Using Tmdb cache: {cache_path!r} (ttl: {ttl}s, max entries: {max_entries}, refresh: {refresh})")
+    cache = Cache(cache_path, ttl=ttl, max_entries=max_entries, refresh=refresh)
+
+
+def close_cache():
+    global cache
+    if cache is None:
+        return
+    try:
+        cache.close()
+    except Exception:
+        logger.exception(f"Exception closing Tmdb cache {cache.cache_path!r}: ")
+    cache = None
+
+
+atexit.register(close_cache)
+
+
+def request_tmdb(endpoint, fetch):
+    delay = 1.0
+    for attempt in range(1, TMDB_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            with metrics.timer('tmdb', endpoint) as timing:
+                info = fetch()
+                timing['bytes'] = len(json.dumps(info))
+                return info
+        except requests.exceptions.HTTPError as ex:
+            if ex.response is None or ex.response.status_code != 429 or attempt == TMDB_MAX_RETRIES:
+                raise
+
+            # rate limited, back off every worker before retrying
+            retry_after = ex.response.headers.get('Retry-After', '')
+            wait_time = float(retry_after) if retry_after.isdigit() else delay
+            logger.debug(f"Rate limited by Tmdb, retrying in {wait_time}s (attempt {attempt}/{TMDB_MAX_RETRIES})")
+            rate_limiter.pause(wait_time)
+            time.sleep(wait_time)
+            delay *= 2
+
+
+def get_cached_info(endpoint, key, fetch):
+    if cache is None:
+        return request_tmdb(endpoint, fetch)
+
+    # use cached response
+    info = cache.get(endpoint, key)
+    if info is not None:
+        return info
+
+    # retrieve response, falling back to a stale cached response when offline
+    try:
+        info = request_tmdb(endpoint, fetch)
+    except Exception:
+        info = cache.get(endpoint, key, allow_stale=True)
+        if info is None:
+            raise
+        logger.warning(f"Failed retrieving {endpoint}/{key} from Tmdb, using stale cached response")
+        return info
+
+    if isinstance(info, dict):
+        cache.set(endpoint, key, info)
+    return info
+
 
 def get_tmdb_id_details(tmdb_id):
     logger.debug(f"Retrieving movie details for: {tmdb_id!r}")
@@ -16,12 +98,15 @@ def get_tmdb_id_details(tmdb_id):
 
     # retrieve movie details
     try:
-        movie = tmdb.Movies(tmdb_id).info()
+        movie = get_cached_info('movie', tmdb_id, lambda: tmdb.Movies(tmdb_id).info())
         # validate response
         if not isinstance(movie, dict) or not misc.dict_contains_keys(movie, ['id', 'imdb_id', 'title']):
             logger.error(f"Failed retrieving movie details from Tmdb for: {tmdb_id!r}")
             return None
 
+        logger.trace(f"Retrieved Tmdb movie details for {tmdb_id!r}:")
+        logger.trace(json.dumps(movie, indent=2))
+
         # build response
         return {
             'title': movie['title'],
@@ -43,7 +128,7 @@ def get_tmdb_collection_parts(tmdb_id):
         tmdb.API_KEY = TMDB_KEY
 
         # get collection details
-        details = tmdb.Collections(tmdb_id).info()
+        details = get_cached_info('collection', tmdb_id, lambda: tmdb.Collections(tmdb_id).info())
         if not isinstance(details, dict) or not misc.dict_contains_keys(details,
                                                                         ['id', 'name', 'parts', 'poster_path']):
             logger.error(f"Failed retrieving movie collection details from Tmdb for: {tmdb_id!r}")
@@ -56,38 +141,15 @@ def get_tmdb_collection_parts(tmdb_id):
         collection_details['poster_url'] = f"https://image.tmdb.org/t/p/original{details['poster_path']}"
         collection_details['overview'] = details['overview'] if 'overview' in details else ''
 
+        # retrieve movie details of all parts
+        part_ids = []
         for collection_part in details['parts']:
             if not misc.dict_contains_keys(collection_part, ['id', 'title']):
                 logger.error(f"Failed processing collection part due to unexpected keys: {collection_part}")
-                return None
-
-            # retrieve movie details
-            logger.debug(f"Retrieving movie details for collection part: {collection_part['title']!r} - "
-                         f"TmdbId: {collection_part['id']}")
-            movie = tmdb.Movies(collection_part['id']).info()
-
-            # validate response
-            if not isinstance(movie, dict) or not misc.dict_contains_keys(movie, ['id', 'imdb_id', 'title']):
-                logger.error(f"Failed retrieving movie details from Tmdb for: {collection_part['title']!r} - "
-                             f"TmdbId: {collection_part['id']}")
-                return None
-
-            # add part to collection details
-            if 'parts' in collection_details:
-                collection_details['parts'].append({
-                    'title': movie['title'],
-                    'tmdb_id': movie['id'],
-                    'imdb_id': movie['imdb_id']
-                })
-            else:
-                collection_details['parts'] = [{
-                    'title': movie['title'],
-                    'tmdb_id': movie['id'],
-                    'imdb_id': movie['imdb_id']
-                }]
-
-            logger.trace(f"Retrieved Tmdb movie details for {collection_part['id']!r}:")
-            logger.trace(json.dumps(movie, indent=2))
+                continue
+            part_ids.append(collection_part['id'])
+
+        collection_details['parts'] = [movie for movie in get_tmdb_movies_details(part_ids) if movie is not None]
 
         logger.debug(json.dumps(collection_details, indent=2))
         return collection_details
@@ -95,3 +157,14 @@ def get_tmdb_collection_parts(tmdb_id):
     except Exception:
         logger.exception(f"Exception retrieving Tmdb collection details for {tmdb_id!r}: ")
     return None
+
+
+def get_tmdb_movies_details(tmdb_ids, concurrency=TMDB_CONCURRENCY):
+    """
+    Retrieve the movie details of every tmdb_id concurrently.
+
+    Returns a list in the same order as tmdb_ids, with None in place of the movies that could not be retrieved.
+    """
+    logger.debug(f"Retrieving movie details for {len(tmdb_ids)} movies")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(get_tmdb_id_details, tmdb_ids))